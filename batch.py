@@ -0,0 +1,142 @@
+import argparse
+import concurrent.futures
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+
+import server
+
+
+def _open(path):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def read_products(path, chunk_size=1 << 16):
+    """Yields the products in path, which is either JSONL (like the Open Food Facts
+    dump, optionally gzipped) or a JSON array (like explorer/binary/products.json).
+    Both are read incrementally, so memory use doesn't depend on the file size."""
+    decoder = json.JSONDecoder()
+    with _open(path) as f:
+        buf = f.read(chunk_size)
+        stripped = buf.lstrip()
+        if stripped.startswith("["):
+            buf = stripped[1:]
+            while True:
+                buf = buf.lstrip().lstrip(",").lstrip()
+                if buf.startswith("]"):
+                    return
+                try:
+                    prod, end = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    chunk = f.read(chunk_size)
+                    if chunk == "":
+                        raise
+                    buf += chunk
+                    continue
+                yield prod
+                buf = buf[end:]
+        else:
+            while True:
+                lines = buf.split("\n")
+                buf = lines.pop()
+                for line in lines:
+                    if line.strip() != "":
+                        yield server.json_loads(line)
+                chunk = f.read(chunk_size)
+                if chunk == "":
+                    break
+                buf += chunk
+            if buf.strip() != "":
+                yield server.json_loads(buf)
+
+
+def product_code(prod, idx):
+    for key in ["code", "ciqual_code"]:
+        if key in prod:
+            return str(prod[key])
+    return str(idx)
+
+
+def run(serv, products, out, logging=logging.getLogger("batch")):
+    """Estimates products using serv, with at most twice as many products read as
+    there are concurrent estimations, and writes one JSONL line per decoration to
+    out as soon as it is done. Products whose decoration can't be written are
+    logged and counted as failed."""
+    stats = {"read": 0, "skipped": 0, "written": 0, "failed": 0}
+    lock = threading.Lock()
+    slots = threading.Semaphore(2 * serv.estimation_concurrency)
+
+    def estimate(prod):
+        try:
+            decoration = serv._bsonify(serv._decorate(prod))
+            line = server.json_dumps({
+                "code": prod["code"],
+                "ecoscore_extended_data": decoration,
+                "ecoscore_extended_data_version": serv.estimation_version,
+                })
+            with lock:
+                out.write(line + "\n")
+                stats["written"] += 1
+        except Exception as e:
+            logging.info(f"💀 {prod['code']}: {e.__class__.__name__}: {e}")
+            with lock:
+                stats["failed"] += 1
+        finally:
+            slots.release()
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=serv.estimation_concurrency) as executor:
+        for idx, prod in enumerate(products):
+            stats["read"] += 1
+            if "ingredients" not in prod or "nutriments" not in prod:
+                stats["skipped"] += 1
+                continue
+            prod["code"] = product_code(prod, idx)
+            if not serv.in_shard(prod):
+                stats["skipped"] += 1
+                continue
+            slots.acquire()
+            executor.submit(estimate, prod)
+    serv.estimator_pool.close()
+    stats["seconds"] = time.monotonic() - start
+    logging.info(f"❤️  Read {stats['read']}, skipped {stats['skipped']}, wrote {stats['written']} and failed {stats['failed']} products in {stats['seconds']:.0f}s")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the impacts of products in a file, without a productopener service.")
+    parser.add_argument("input", help="JSONL (optionally gzipped) or JSON array of products, - for stdin")
+    parser.add_argument("output", help="JSONL file to write decorations to, - for stdout")
+    parser.add_argument("--estimation_workers", help="Number of pre-warmed estimation processes to keep running", type=int, default=1)
+    parser.add_argument("--cache_size", help="Number of estimations to keep in memory for products with identical inputs (0 disables the cache)", type=int, default=10000)
+    parser.add_argument("--cache_path", help="Path to a SQLite file keeping cached estimations across runs")
+    parser.add_argument("--cache_disk_size", help="Number of most recently used estimations to keep in the cache_path file", type=int, default=100000)
+    parser.add_argument("--shard_index", help="Index of the shard of products, by code, to estimate", type=int, default=0)
+    parser.add_argument("--shard_count", help="Number of shards to split the products into, to estimate them on several machines", type=int, default=1)
+    parser.add_argument("--impact_categories", help="Comma separated impact categories to estimate, like EF single score,Climate change", type=server.parse_impact_categories, default=server.DEFAULT_IMPACT_CATEGORIES)
+    parser.add_argument("--decoration_percentiles", help="Comma separated percentiles of the impact distributions to add to the decorations, like 5,50,95", type=server.parse_percentiles, default=())
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    serv = server.Server(
+            logging=logging.getLogger("batch"),
+            estimation_workers=args.estimation_workers,
+            cache_size=args.cache_size,
+            cache_path=args.cache_path,
+            cache_disk_size=args.cache_disk_size,
+            decoration_percentiles=args.decoration_percentiles,
+            impact_categories=args.impact_categories,
+            shard_index=args.shard_index,
+            shard_count=args.shard_count)
+    if args.output == "-":
+        run(serv, read_products(args.input), sys.stdout)
+    else:
+        with open(args.output, "w", encoding="utf-8") as out:
+            run(serv, read_products(args.input), out)
@@ -0,0 +1,105 @@
+import unittest
+
+import copy
+import json
+import re
+import timeit
+import numpy as np
+
+import server
+
+
+def legacy_bsonify(m):
+    """The recursive Server._bsonify that server.sanitize replaced, kept to compare against."""
+    if isinstance(m, dict):
+        res = {}
+        for k in m:
+            v = legacy_bsonify(m[k])
+            k = re.sub(r'[^:-_a-zA-Z0-9]', '_', k)
+            res[k] = v
+        return res
+    elif isinstance(m, list):
+        res = []
+        for e in m:
+            res.append(legacy_bsonify(e))
+        return res
+    elif isinstance(m, tuple):
+        res = []
+        for e in m:
+            res.append(legacy_bsonify(e))
+        return tuple(res)
+    else:
+        return m
+
+
+def explorer_products():
+    with open("explorer/binary/products.json") as f:
+        return json.load(f)
+
+
+def realistic_decoration(prod, rng):
+    """Builds a decoration shaped like the ones the update loop stores, with NumPy
+    values where the estimator returns them, from an explorer product."""
+    ingredient_ids = [ingredient["id"] for ingredient in prod["ingredients"]]
+    recipe = {ingredient_id: np.float64(rng.uniform(0, 100)) for ingredient_id in ingredient_ids * 5}
+    return {
+            "impact": {
+                "likeliest_recipe": recipe,
+                "likeliest_impacts": {
+                    "Climate change": np.float64(rng.uniform(0, 10)),
+                    "EF single score": np.float64(rng.uniform(0, 1)),
+                },
+                "ef_single_score_log_stddev": np.float64(rng.uniform(0, 1)),
+                "mass_ratio_uncharacterized": 0.1,
+                "uncharacterized_ingredients": {"impact": ingredient_ids[:2], "nutrition": []},
+                "uncharacterized_ingredients_mass_proportion": {"impact": 0.1, "nutrition": 0.0},
+                "uncharacterized_ingredients_ratio": {"impact": 0.1, "nutrition": 0.0},
+                "warnings": [f"The product has an ingredient with an unknown impact: {ingredient_id}" for ingredient_id in ingredient_ids] * 3,
+            },
+    }
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def testSanitize(self):
+        rng = np.random.default_rng(1)
+        decorations = [realistic_decoration(prod, rng) for prod in explorer_products()]
+        for decoration in decorations:
+            assert(server.sanitize(copy.deepcopy(decoration)) == legacy_bsonify(decoration))
+        nested = {"a b": [({"c d": np.int64(1)},), np.array([1.5, 2.5])]}
+        assert(server.sanitize(nested) == {"a_b": [({"c_d": 1},), [1.5, 2.5]]})
+        sanitized = [server.sanitize(d) for d in decorations]
+        number = 20
+        for name, ds in [("raw", decorations), ("already sanitized", sanitized)]:
+            legacy = timeit.timeit(lambda: [legacy_bsonify(d) for d in ds], number=number)
+            current = timeit.timeit(lambda: [server.sanitize(d) for d in ds], number=number)
+            print(f" * Sanitizing {len(ds)} {name} decorations {number} times")
+            print(f"   * legacy _bsonify: {legacy:.3f}s")
+            print(f"   * sanitize: {current:.3f}s ({legacy / current:.1f}x)")
+
+    def testJson(self):
+        products = explorer_products()
+        rng = np.random.default_rng(1)
+        pages = []
+        for i in range(0, len(products), 20):
+            pages.append(json.dumps({"products": products[i:i+20]}).encode("utf-8"))
+        decorations = [realistic_decoration(prod, rng) for prod in products]
+        for page in pages:
+            assert(server.json_loads(page) == json.loads(page.decode("utf-8")))
+        for decoration in decorations:
+            assert(json.loads(server.json_dumps(decoration)) == json.loads(json.dumps(decoration)))
+        number = 20
+        stdlib = timeit.timeit(lambda: [json.loads(page.decode("utf-8")) for page in pages], number=number)
+        current = timeit.timeit(lambda: [server.json_loads(page) for page in pages], number=number)
+        print(f" * Decoding {len(pages)} search pages {number} times")
+        print(f"   * json.loads(response.text): {stdlib:.3f}s")
+        print(f"   * json_loads(response.content): {current:.3f}s ({stdlib / current:.1f}x)")
+        stdlib = timeit.timeit(lambda: [json.dumps(d) for d in decorations], number=number)
+        current = timeit.timeit(lambda: [server.json_dumps(d) for d in decorations], number=number)
+        print(f" * Encoding {len(decorations)} decorations {number} times")
+        print(f"   * json.dumps: {stdlib:.3f}s")
+        print(f"   * json_dumps: {current:.3f}s ({stdlib / current:.1f}x)")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def canonical_hash(*parts):
+    """Returns a hex digest of parts that only depends on their content, not on
+    key order or formatting."""
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=float)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def input_fingerprint(product, estimator_version, impact_categories, percentiles=()):
+    """Returns a hash of what the estimation of product depends on. Unlike the
+    cache keys, it doesn't change with the estimation version, so a decoration
+    can be carried over to a new version when its inputs are the same."""
+    parts = [product.get("ingredients"), product.get("nutriments"), estimator_version, impact_categories]
+    # Only part of the hash when set, so existing fingerprints stay valid.
+    if len(percentiles) > 0:
+        parts.append(list(percentiles))
+    return canonical_hash(*parts)
+
+
+class ResultCache:
+    """An LRU cache of decorations keyed by the input fingerprint of products, with
+    an optional SQLite file behind it so that results survive restarts.
+    Values must be JSON serializable.
+
+    The file keeps the disk_size most recently used entries: whenever a tenth of
+    that has been added, the least recently used ones beyond it are deleted."""
+
+    def __init__(self, size=10000, path=None, disk_size=100000):
+        self.size = size
+        self.disk_size = disk_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._added = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, last_used REAL NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(results)")]
+            if "last_used" not in columns:
+                # Created before entries were pruned.
+                self._db.execute("ALTER TABLE results ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self._prune()
+            self._db.commit()
+
+    def key(self, fingerprint, estimation_version):
+        """Returns the key of the decoration of a product with the input_fingerprint
+        fingerprint, for estimation_version."""
+        return canonical_hash(fingerprint, estimation_version)
+
+    def get(self, key):
+        """Returns a fresh copy of the value stored for key, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return json.loads(self._entries[key])
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self._remember(key, row[0])
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        encoded = json.dumps(value, default=float)
+        with self._lock:
+            self._remember(key, encoded)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results (key, value, last_used) VALUES (?, ?, ?)", (key, encoded, time.time()))
+                self._added += 1
+                if self._added >= max(1, self.disk_size // 10):
+                    self._prune()
+                self._db.commit()
+
+    def _prune(self):
+        self._added = 0
+        self._db.execute(
+                "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY last_used DESC LIMIT ?)",
+                (self.disk_size,))
+
+    def _remember(self, key, encoded):
+        self._entries[key] = encoded
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
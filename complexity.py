@@ -0,0 +1,66 @@
+import collections
+import threading
+
+
+def measure(product):
+    """Returns the number of ingredients of product (including sub ingredients),
+    how deeply they are nested, and how many of them are unknown to the
+    ingredients taxonomy."""
+    ingredients = 0
+    depth = 0
+    unknown = 0
+    stack = [(product.get("ingredients") or [], 1)]
+    while stack:
+        items, level = stack.pop()
+        for ingredient in items:
+            ingredients += 1
+            depth = max(depth, level)
+            if ingredient.get("is_in_taxonomy") == 0 or ingredient.get("known") is False:
+                unknown += 1
+            if ingredient.get("ingredients"):
+                stack.append((ingredient["ingredients"], level + 1))
+    return {"ingredients": ingredients, "depth": depth, "unknown": unknown}
+
+
+def cost(product):
+    """Returns the relative cost of estimating product. The recipes to sample grow
+    with the number of ingredients, and more so when they are nested (every level
+    adds proportions to pick) or unknown (they widen the distributions, so it takes
+    more runs for the confidence to converge)."""
+    m = measure(product)
+    return max(1, m["ingredients"] + 2 * m["unknown"]) * (1 + 0.5 * max(0, m["depth"] - 1))
+
+
+class DeadlineModel:
+    """Derives the deadline of an estimation from the cost of the product and the
+    seconds per unit of cost that recent successful estimations took.
+
+    Until min_history estimations have been observed every product gets maximum
+    seconds, afterwards margin times the expected seconds, but at least minimum."""
+
+    def __init__(self, minimum=60, maximum=600, margin=4, history=500, min_history=20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.margin = margin
+        self.min_history = min_history
+        self._ratios = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def observe(self, cost, seconds):
+        with self._lock:
+            self._ratios.append(seconds / cost)
+
+    def expected_seconds(self, cost):
+        """Returns the 95th percentile of the seconds an estimation of cost takes,
+        or None without enough history."""
+        with self._lock:
+            if len(self._ratios) < self.min_history:
+                return None
+            ratios = sorted(self._ratios)
+        return ratios[min(len(ratios) - 1, int(0.95 * len(ratios)))] * cost
+
+    def deadline(self, cost):
+        expected = self.expected_seconds(cost)
+        if expected is None:
+            return self.maximum
+        return min(self.maximum, max(self.minimum, self.margin * expected))
@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import time
+
+
+class Journal:
+    """An append-only JSONL log of the state of every product going through the
+    update loop: "fetched", then "estimated" (with its decoration), then "written".
+
+    When opened, the log is replayed and compacted to the products that never
+    reached "written", so that estimations finished before a restart (or whose
+    write-back failed) can be written without being computed again. Decorations
+    of another estimation_version than the current one are dropped.
+
+    The log is compacted again whenever every product recorded in it has been
+    written, and every compact_lines lines otherwise."""
+
+    def __init__(self, path, estimation_version=None, compact_lines=10000):
+        self.path = path
+        self.estimation_version = estimation_version
+        self.compact_lines = compact_lines
+        self._lock = threading.Lock()
+        self._unfinished = self._replay()
+        self._taken = False
+        self._compact()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lines = 0
+
+    def _replay(self):
+        latest = {}
+        if not os.path.exists(self.path):
+            return latest
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash while it was being written.
+                    continue
+                if entry["state"] == "written":
+                    latest.pop(entry["code"], None)
+                elif entry["state"] == "estimated" and entry.get("estimation_version") != self.estimation_version:
+                    # Estimated by another version, so it has to be estimated again.
+                    latest.pop(entry["code"], None)
+                else:
+                    latest[entry["code"]] = entry
+        return latest
+
+    def _compact(self):
+        # Products not estimated yet will be found by the search again.
+        self._unfinished = {code: entry for code, entry in self._unfinished.items() if entry["state"] == "estimated"}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._unfinished.values():
+                f.write(json.dumps(entry, default=float) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def take_estimated(self):
+        """Returns (product, decoration) for every product that was estimated but
+        not written when the journal was opened, the first time it is called."""
+        with self._lock:
+            if self._taken:
+                return []
+            self._taken = True
+            return [(entry["product"], entry["decoration"]) for entry in self._unfinished.values() if entry["state"] == "estimated"]
+
+    def record(self, prod, state, decoration=None):
+        entry = {
+                "code": prod.get("code"),
+                "state": state,
+                "time": time.time(),
+                }
+        if decoration is not None:
+            entry["product"] = {k: prod[k] for k in ["code", "product_name"] if k in prod}
+            entry["decoration"] = decoration
+            entry["estimation_version"] = self.estimation_version
+        line = json.dumps(entry, default=float) + "\n"
+        with self._lock:
+            if state == "written":
+                self._unfinished.pop(entry["code"], None)
+            else:
+                self._unfinished[entry["code"]] = entry
+            self._file.write(line)
+            self._file.flush()
+            self._lines += 1
+            if (state == "written" and len(self._unfinished) == 0) or self._lines >= self.compact_lines:
+                self._file.close()
+                self._compact()
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._lines = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -1,29 +1,96 @@
-from fastapi import FastAPI
+from fastapi import Body, FastAPI, Header
+from fastapi.responses import PlainTextResponse, Response
 
 import argparse
 import uvicorn
 import os
 
+import remote
 import server
 
 
 parser = argparse.ArgumentParser(description="Start the impact estimator service.")
+parser.add_argument("--mode", help="'standalone' to fetch, estimate and store products, 'coordinator' to fetch and store them but estimate them on the estimation_endpoints, 'worker' to only serve estimations to a coordinator on /estimate", choices=["standalone", "coordinator", "worker"], default=os.environ.get("MODE", "standalone"))
+parser.add_argument("--estimation_endpoints", help="Comma separated base URLs of the workers estimating products for a coordinator", default=os.environ.get("ESTIMATION_ENDPOINTS", ""))
+parser.add_argument("--estimation_token", help="Shared secret a coordinator sends to its workers, which refuse estimations without it", default=os.environ.get("ESTIMATION_TOKEN"))
+parser.add_argument("--estimation_endpoint_slots", help="Number of products a coordinator has estimated concurrently by each worker (their number of estimation workers)", type=int, default=int(os.environ.get("ESTIMATION_ENDPOINT_SLOTS", "1")))
 parser.add_argument("--productopener_base_url", help="Base URL to the productopener service", default=os.environ.get("PRODUCT_OPENER_URL"))
 parser.add_argument("--productopener_username", help="Username for the productopener service", default=os.environ.get("PRODUCT_OPENER_USERNAME"))
 parser.add_argument("--productopener_password", help="Password for the productopener service", default=os.environ.get("PRODUCT_OPENER_PASSWORD"))
 parser.add_argument("--productopener_host_header", help="Host header in requests to avoid extra redirects in the responses", default=os.environ.get("PRODUCT_OPENER_HOST_HEADER"))
 parser.add_argument("--productopener_basic_auth_username", help="Basic auth username for the productopener service", default=os.environ.get("PRODUCT_OPENER_BASIC_AUTH_USERNAME"))
 parser.add_argument("--productopener_basic_auth_password", help="Basic auth password for the productopener service", default=os.environ.get("PRODUCT_OPENER_BASIC_AUTH_PASSWORD"))
+parser.add_argument("--estimation_workers", help="Number of pre-warmed estimation processes to keep running", type=int, default=int(os.environ.get("ESTIMATION_WORKERS", "1")))
+parser.add_argument("--estimation_concurrency", help="Number of products to estimate concurrently (defaults to the number of estimation workers)", type=int, default=int(os.environ.get("ESTIMATION_CONCURRENCY", "0")))
+parser.add_argument("--poll_backoff_min", help="Seconds to wait before polling again after a partial or empty page", type=float, default=float(os.environ.get("POLL_BACKOFF_MIN", "5")))
+parser.add_argument("--poll_backoff_max", help="Maximum seconds to wait before polling again after repeated empty pages or errors", type=float, default=float(os.environ.get("POLL_BACKOFF_MAX", "600")))
+parser.add_argument("--http_pool_size", help="Maximum number of kept-alive connections to the productopener service", type=int, default=int(os.environ.get("HTTP_POOL_SIZE", "10")))
+parser.add_argument("--http_timeout", help="Seconds before requests to the productopener service time out", type=float, default=float(os.environ.get("HTTP_TIMEOUT", "60")))
+parser.add_argument("--http_retries", help="Number of retries of failed requests to the productopener service", type=int, default=int(os.environ.get("HTTP_RETRIES", "3")))
+parser.add_argument("--writeback_concurrency", help="Number of decorations to write back concurrently from an asynchronous client (0 writes them one at a time)", type=int, default=int(os.environ.get("WRITEBACK_CONCURRENCY", "0")))
+parser.add_argument("--page_size", help="Number of products to fetch per search page", type=int, default=int(os.environ.get("PAGE_SIZE", "20")))
+parser.add_argument("--search_sort_by", help="Sort order of the product search, use a stable key like created_t when sweeping", default=os.environ.get("SEARCH_SORT_BY", "nothing"))
+parser.add_argument("--search_paging", help="'first' to always fetch the first search page, 'sweep' to walk through the pages", choices=["first", "sweep"], default=os.environ.get("SEARCH_PAGING", "first"))
+parser.add_argument("--cache_size", help="Number of estimations to keep in memory for products with identical inputs (0 disables the cache)", type=int, default=int(os.environ.get("CACHE_SIZE", "10000")))
+parser.add_argument("--cache_path", help="Path to a SQLite file keeping cached estimations across restarts", default=os.environ.get("CACHE_PATH"))
+parser.add_argument("--cache_disk_size", help="Number of most recently used estimations to keep in the cache_path file", type=int, default=int(os.environ.get("CACHE_DISK_SIZE", "100000")))
+parser.add_argument("--journal_path", help="Path to a JSONL journal of product states, used to write estimations finished before a restart", default=os.environ.get("JOURNAL_PATH"))
+parser.add_argument("--trace_path", help="Path to a JSONL file to write per product stage timings to", default=os.environ.get("TRACE_PATH"))
+parser.add_argument("--trace_profile_threshold", help="Attach cProfile output to traced estimations taking longer than this many seconds", type=float, default=float(os.environ["TRACE_PROFILE_THRESHOLD"]) if "TRACE_PROFILE_THRESHOLD" in os.environ else None)
+parser.add_argument("--estimation_deadline", help="Maximum seconds an estimation may take before its process is replaced", type=float, default=float(os.environ.get("ESTIMATION_DEADLINE", "600")))
+parser.add_argument("--estimation_deadline_min", help="Minimum seconds given to an estimation when deriving its deadline from its complexity and the time recent estimations took (set to the maximum for a fixed deadline)", type=float, default=float(os.environ.get("ESTIMATION_DEADLINE_MIN", "60")))
+parser.add_argument("--scheduling", help="'cheapest_first' to estimate the products predicted to be cheapest first, 'fifo' to estimate them in the order they are found", choices=["cheapest_first", "fifo"], default=os.environ.get("SCHEDULING", "cheapest_first"))
+parser.add_argument("--dedicated_estimators", help="Number of the concurrent estimations reserved for expensive products", type=int, default=int(os.environ.get("DEDICATED_ESTIMATORS", "0")))
+parser.add_argument("--expensive_cost", help="Predicted cost (roughly the number of ingredients, more when nested or unknown) from which products are expensive", type=float, default=float(os.environ.get("EXPENSIVE_COST", "40")))
+parser.add_argument("--shard_index", help="Index of the shard of products, by barcode, that this replica estimates", type=int, default=int(os.environ.get("SHARD_INDEX", "0")))
+parser.add_argument("--shard_count", help="Number of replicas splitting the products between them", type=int, default=int(os.environ.get("SHARD_COUNT", "1")))
+parser.add_argument("--impact_categories", help="Comma separated impact categories to estimate, like EF single score,Climate change", type=server.parse_impact_categories, default=server.parse_impact_categories(os.environ.get("IMPACT_CATEGORIES", ",".join(server.DEFAULT_IMPACT_CATEGORIES))))
+parser.add_argument("--decoration_percentiles", help="Comma separated percentiles of the impact distributions to add to the decorations, like 5,50,95", type=server.parse_percentiles, default=server.parse_percentiles(os.environ.get("DECORATION_PERCENTILES", "")))
 parser.add_argument("--monitoring_port", help="Port to serve monitoring on", default=os.environ.get("MONITORING_PORT"))
 args = parser.parse_args()
 
+estimation_endpoints = [endpoint.strip() for endpoint in args.estimation_endpoints.split(",") if endpoint.strip() != ""]
+if args.mode == "coordinator" and len(estimation_endpoints) == 0:
+    parser.error("a coordinator needs estimation_endpoints")
+if args.mode in ["coordinator", "worker"] and not args.estimation_token:
+    parser.error(f"a {args.mode} needs an estimation_token")
+
 serv = server.Server(
         productopener_base_url=args.productopener_base_url,
         productopener_host_header=args.productopener_host_header,
         productopener_basic_auth_username=args.productopener_basic_auth_username,
         productopener_basic_auth_password=args.productopener_basic_auth_password,
         productopener_username=args.productopener_username,
-        productopener_password=args.productopener_password)
+        productopener_password=args.productopener_password,
+        estimation_workers=args.estimation_workers,
+        estimation_concurrency=args.estimation_concurrency,
+        poll_backoff_min=args.poll_backoff_min,
+        poll_backoff_max=args.poll_backoff_max,
+        http_pool_size=args.http_pool_size,
+        http_timeout=args.http_timeout,
+        http_retries=args.http_retries,
+        writeback_concurrency=args.writeback_concurrency,
+        page_size=args.page_size,
+        search_sort_by=args.search_sort_by,
+        search_paging=args.search_paging,
+        cache_size=args.cache_size,
+        cache_path=args.cache_path,
+        cache_disk_size=args.cache_disk_size,
+        journal_path=args.journal_path,
+        trace_path=args.trace_path,
+        trace_profile_threshold=args.trace_profile_threshold,
+        decoration_percentiles=args.decoration_percentiles,
+        impact_categories=args.impact_categories,
+        estimation_deadline=args.estimation_deadline,
+        estimation_deadline_min=args.estimation_deadline_min,
+        scheduling=args.scheduling,
+        dedicated_estimators=args.dedicated_estimators,
+        expensive_cost=args.expensive_cost,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        estimation_endpoints=estimation_endpoints if args.mode == "coordinator" else None,
+        estimation_endpoint_slots=args.estimation_endpoint_slots,
+        estimation_token=args.estimation_token)
 
 
 serv.logging.info(f"Service starting with productopener_base_url {args.productopener_base_url}")
@@ -32,11 +99,27 @@ app = FastAPI()
 
 @app.get("/")
 def stats():
-    return serv.stats
+    return serv.get_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(serv.metrics.render(), media_type="text/plain; version=0.0.4")
+
+if args.mode == "worker":
+    @app.post("/estimate")
+    def estimate(payload: dict = Body(...), authorization: str = Header(None)):
+        """Estimates a product for a coordinator, see remote.RemoteEstimator."""
+        if not remote.authorized(args.estimation_token, authorization):
+            return Response(server.json_dumps({"error": "wrong estimation token"}), status_code=401, media_type="application/json")
+        status, reply = remote.handle(serv.estimator_pool, payload)
+        return Response(server.json_dumps(reply), status_code=status, media_type="application/json")
 
 @app.on_event("startup")
 def startup():
-    serv.start_update_loop()
+    if args.mode == "worker":
+        serv.estimator_pool.start()
+    else:
+        serv.start_update_loop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import bisect
+import threading
+
+
+# Estimations take from a few seconds to the 10 minute deadline, requests a few
+# milliseconds, so the buckets span both.
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def render(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose value is read from fn when rendered."""
+
+    def __init__(self, name, help, fn, type="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.type = type
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", f"{self.name} {_format(self.fn())}"]
+
+
+class Registry:
+    """Holds the metrics of a server, and renders them in the Prometheus text
+    exposition format."""
+
+    def __init__(self, prefix="impactestimator_"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self.prefix + name, help, buckets=buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, fn):
+        metric = Gauge(self.prefix + name, help, fn)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, fn):
+        metric = Gauge(self.prefix + name, help, fn, type="counter")
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
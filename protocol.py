@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Shared by server.py and remote.py, which estimates for it on other nodes, so
+# that neither has to import the other.
+
+
+class EstimationTimeout(Exception):
+    """Raised when an estimation process doesn't get ready (stage "startup") or
+    doesn't produce a result (stage "estimation") before its deadline."""
+
+    def __init__(self, stage, deadline):
+        super().__init__(f"estimation process timed out after {deadline:g} seconds")
+        self.stage = stage
+        self.deadline = deadline
+
+
+class WorkersUnavailable(Exception):
+    """Raised when no estimation worker of another node could estimate a product,
+    which says nothing about the product itself."""
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def json_loads(data):
+    """Decodes JSON from bytes or str, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Encodes obj, which may contain NumPy values, to a JSON str, with orjson
+    when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY, default=_json_default).decode("utf-8")
+    return json.dumps(obj, default=_json_default)
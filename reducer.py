@@ -0,0 +1,65 @@
+import re
+
+import numpy as np
+
+
+def percentile_key(q):
+    """Returns the decoration key of the q-th percentile, like p5 or p97_5."""
+    return "p" + f"{q:g}".replace(".", "_")
+
+
+def category_slug(category):
+    """Returns the decoration key prefix of an impact category, like ef_single_score."""
+    return re.sub(r'[^a-z0-9]+', '_', category.lower()).strip("_")
+
+
+def reduce_impact(impact, impact_categories, percentiles=()):
+    """Summarizes an estimate_impacts result (with distributions_as_result).
+
+    The distributions of all categories are stacked into one array, so each
+    statistic is computed in a single NumPy call for all of them.
+
+    Returns the index of the likeliest recipe, and per impact category the
+    likeliest impact, the geometric mean, the standard deviation of the log, and
+    the requested percentiles."""
+    likeliest = int(np.argmax(impact['confidence_score_distribution']))
+    # Shaped (categories, runs).
+    distributions = np.array([impact['impact_distributions'][category] for category in impact_categories], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logs = np.log(distributions)
+        geom_means = np.exp(np.mean(logs, axis=1)).tolist()
+        log_stddevs = np.std(logs, axis=1).tolist()
+    summary = {
+            "likeliest_index": likeliest,
+            "likeliest_impacts": dict(zip(impact_categories, distributions[:, likeliest].tolist())),
+            "geom_means": dict(zip(impact_categories, geom_means)),
+            "log_stddevs": dict(zip(impact_categories, log_stddevs)),
+    }
+    if len(percentiles) > 0:
+        # Shaped (percentiles, categories).
+        quantiles = np.percentile(distributions, list(percentiles), axis=1).tolist()
+        summary["percentiles"] = {
+                category: {percentile_key(q): quantiles[q_idx][c_idx] for q_idx, q in enumerate(percentiles)}
+                for c_idx, category in enumerate(impact_categories)}
+    return summary
+
+
+def decoration(impact, impact_categories, percentiles=()):
+    """Returns the decoration of the estimate_impacts result impact."""
+    summary = reduce_impact(impact, impact_categories, percentiles)
+    result = {
+            "likeliest_recipe": impact['recipes'][summary["likeliest_index"]],
+            "likeliest_impacts": summary["likeliest_impacts"],
+    }
+    for category in impact_categories:
+        result[f"{category_slug(category)}_log_stddev"] = summary["log_stddevs"][category]
+    result.update({
+            "mass_ratio_uncharacterized": impact['uncharacterized_ingredients_mass_proportion']['impact'],
+            "uncharacterized_ingredients": impact['uncharacterized_ingredients'],
+            "uncharacterized_ingredients_mass_proportion": impact['uncharacterized_ingredients_mass_proportion'],
+            "uncharacterized_ingredients_ratio": impact['uncharacterized_ingredients_ratio'],
+            "warnings": impact['warnings'],
+    })
+    if "percentiles" in summary:
+        result["impact_percentiles"] = summary["percentiles"]
+    return {"impact": result}
@@ -0,0 +1,169 @@
+import hmac
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import requests
+import requests.adapters
+
+import protocol
+import tracing
+
+
+class RemoteEstimator:
+    """Hands products to estimation workers on other nodes, through the /estimate
+    endpoint of main.py in worker mode, with the same estimate interface as
+    server.EstimatorPool.
+
+    Every endpoint has a number of slots, and a product holds one until its
+    worker replies, or its deadline (plus grace seconds for the network) passes.
+    A worker that can't be reached, or fails or refuses the request, is considered
+    lost: it gets no new products for cooldown seconds, and the product is
+    dispatched again to another one, up to redispatches times, after which
+    WorkersUnavailable is raised.
+
+    The impact categories and percentiles to reduce the estimations to are sent
+    along with every product, and workers configured for other ones refuse it,
+    as do workers expecting another token."""
+
+    def __init__(self, endpoints, impact_categories, slots=1, logging=logging.getLogger("uvicorn.info"), metrics=None, spans=None,
+                 percentiles=(), token=None, redispatches=2, cooldown=30, grace=30, connect_timeout=5):
+        self.endpoints = [endpoint.rstrip("/") + "/" for endpoint in endpoints]
+        self.impact_categories = impact_categories
+        self.percentiles = tuple(percentiles)
+        self.token = token
+        self.size = len(self.endpoints) * slots
+        self.spans = spans or tracing.Spans()
+        # Profiling happens in the workers, configured there.
+        self.profile_threshold = None
+        self.logging = logging
+        self.redispatches = redispatches
+        self.cooldown = cooldown
+        self.grace = grace
+        self.connect_timeout = connect_timeout
+        self._idle = queue.Queue()
+        for _ in range(slots):
+            for endpoint in self.endpoints:
+                self._idle.put(endpoint)
+        self._lock = threading.Lock()
+        self._down_until = {}
+        self.running = 0
+        self.redispatched = 0
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=slots)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if metrics is not None:
+            metrics.gauge("estimations_running", "Number of estimations running in the worker processes.", lambda: self.running)
+            metrics.counter("estimations_redispatched_total", "Number of estimations dispatched again after losing their worker.", lambda: self.redispatched)
+
+    def start(self):
+        pass
+
+    def wait_ready(self, timeout=600):
+        pass
+
+    def close(self):
+        self.session.close()
+
+    def _acquire(self):
+        """Returns the endpoint of a free slot on a worker that isn't down."""
+        while True:
+            endpoint = self._idle.get()
+            wait = self._down_until.get(endpoint, 0) - time.monotonic()
+            if wait <= 0:
+                return endpoint
+            self._idle.put(endpoint)
+            time.sleep(min(wait, 1))
+
+    def _post(self, endpoint, product, deadline, distributions, time_budget):
+        headers = {"Content-Type": "application/json"}
+        if self.token is not None:
+            headers["Authorization"] = f"Bearer {self.token}"
+        response = self.session.post(
+                endpoint + "estimate",
+                data=protocol.json_dumps({
+                    "product": product,
+                    "deadline": deadline,
+                    "distributions": distributions,
+                    "time_budget": time_budget,
+                    "impact_categories": self.impact_categories,
+                    "decoration_percentiles": self.percentiles,
+                    }),
+                headers=headers,
+                timeout=(self.connect_timeout, deadline + self.grace))
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{endpoint} -> {response.status_code} {response.text[:200]}")
+        return protocol.json_loads(response.content)
+
+    def estimate(self, product, deadline=600, distributions=False, time_budget=None):
+        """Runs the estimation of product on a remote worker, and returns its result
+        like EstimatorPool.estimate does."""
+        code = product.get("code")
+        for attempt in range(self.redispatches + 1):
+            with self.spans.span("worker_wait", code):
+                endpoint = self._acquire()
+            with self._lock:
+                self.running += 1
+            try:
+                with self.spans.span("estimation", code) as attributes:
+                    attributes["endpoint"] = endpoint
+                    reply = self._post(endpoint, product, deadline, distributions, time_budget)
+            except requests.ReadTimeout:
+                # The worker should have replied by the deadline, so it's stuck.
+                self._down_until[endpoint] = time.monotonic() + self.cooldown
+                raise protocol.EstimationTimeout("estimation", deadline)
+            except requests.RequestException as e:
+                self._down_until[endpoint] = time.monotonic() + self.cooldown
+                if attempt == self.redispatches:
+                    raise protocol.WorkersUnavailable(f"estimation worker {endpoint} lost: {e}")
+                self.logging.info(f"🔪 Estimation worker {endpoint} lost ({e}), dispatching {code} again")
+                with self._lock:
+                    self.redispatched += 1
+                continue
+            finally:
+                with self._lock:
+                    self.running -= 1
+                self._idle.put(endpoint)
+            if "error" in reply:
+                if reply.get("timeout_stage") is not None:
+                    raise protocol.EstimationTimeout(reply["timeout_stage"], deadline)
+                raise Exception(reply["error"])
+            result = reply["result"]
+            if "distributions" in result:
+                result["distributions"] = {key: np.asarray(values) for key, values in result["distributions"].items()}
+            return result
+
+
+def authorized(token, authorization):
+    """Returns whether the Authorization header authorization carries token."""
+    return authorization is not None and hmac.compare_digest(authorization, f"Bearer {token}")
+
+
+def handle(pool, payload):
+    """Runs the estimation requested by a RemoteEstimator in pool, and returns the
+    HTTP status and the reply for it. Products to reduce to other impact
+    categories or percentiles than pool does are refused with a 409, so that the
+    coordinator sends them to another worker."""
+    categories = payload.get("impact_categories")
+    if categories is not None and list(categories) != list(pool.impact_categories):
+        return 409, {"error": f"estimation worker reduces to impact categories {list(pool.impact_categories)}, not {list(categories)}"}
+    percentiles = payload.get("decoration_percentiles")
+    if percentiles is not None and [float(q) for q in percentiles] != [float(q) for q in pool.percentiles]:
+        return 409, {"error": f"estimation worker reduces to percentiles {list(pool.percentiles)}, not {list(percentiles)}"}
+    try:
+        result = pool.estimate(
+                payload["product"],
+                deadline=payload.get("deadline", 600),
+                distributions=payload.get("distributions", False),
+                time_budget=payload.get("time_budget"))
+    except protocol.EstimationTimeout as e:
+        return 200, {"error": str(e), "timeout_stage": e.stage}
+    except Exception as e:
+        error = str(e) if type(e) is Exception else f"{e.__class__.__name__}: {e}"
+        return 200, {"error": error}
+    if "distributions" in result:
+        result["distributions"] = {key: values.tolist() for key, values in result["distributions"].items()}
+    return 200, {"result": result}
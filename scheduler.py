@@ -0,0 +1,90 @@
+import itertools
+import threading
+import time
+
+
+class Scheduler:
+    """A bounded queue between the fetcher and the estimator stages, which hands
+    out products by their predicted cost instead of in arrival order.
+
+    With the "cheapest_first" policy the cheapest waiting product goes first, so
+    the easy part of a backlog drains quickly. Waiting makes a product look
+    cheaper, halving its cost after aging_seconds, so that expensive products
+    aren't starved by a steady stream of cheap ones. The "fifo" policy keeps the
+    arrival order.
+
+    With expensive_cost set, products costing at least that much are expensive.
+    Dedicated consumers only take expensive products, so a few of them always
+    make progress on those, and the others take cheap products first, and
+    expensive ones only when no cheap product is waiting."""
+
+    def __init__(self, maxsize, policy="cheapest_first", expensive_cost=None, aging_seconds=300):
+        if policy not in ["cheapest_first", "fifo"]:
+            raise ValueError(f"unknown scheduling policy {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.expensive_cost = expensive_cost
+        self.aging_seconds = aging_seconds
+        self._entries = []
+        self._seq = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def qsize(self):
+        with self._cond:
+            return len(self._entries)
+
+    def _expensive(self, entry):
+        return self.expensive_cost is not None and entry[0] >= self.expensive_cost
+
+    def _priority(self, entry, now):
+        cost, seq, enqueued_at, _ = entry
+        if self.policy == "fifo":
+            return (seq,)
+        return (cost / (1 + (now - enqueued_at) / self.aging_seconds), seq)
+
+    def _pick(self, dedicated):
+        now = time.monotonic()
+        best = None
+        for idx, entry in enumerate(self._entries):
+            expensive = self._expensive(entry)
+            if dedicated and not expensive:
+                continue
+            # Cheap products always go before expensive ones.
+            key = (expensive,) + self._priority(entry, now)
+            if best is None or key < best[0]:
+                best = (key, idx)
+        if best is None:
+            return None
+        return self._entries.pop(best[1])
+
+    def put(self, item, cost):
+        """Adds item, predicted to cost cost, blocking while the queue is full."""
+        with self._cond:
+            while len(self._entries) >= self.maxsize:
+                self._cond.wait()
+            self._entries.append((cost, next(self._seq), time.monotonic(), item))
+            self._cond.notify_all()
+
+    def get(self, dedicated=False):
+        """Returns the next item for a consumer, blocking until there is one.
+        Returns None once the queue is closed and nothing is left for it."""
+        with self._cond:
+            while True:
+                entry = self._pick(dedicated)
+                if entry is not None:
+                    self._cond.notify_all()
+                    return entry[3]
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    def close(self):
+        """Makes consumers get None once the waiting items are taken."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -1,16 +1,554 @@
 import requests
+import requests.adapters
+import urllib3.util.retry
 import logging
 import sys
 import json
 import time
+import os
+import itertools
 import re
+import random
+import collections
+import cProfile
+import io
+import pstats
 import urllib
+import zlib
 import threading
 import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
 import queue
 import numpy as np
+import cache
+import complexity
+import journal
+import metrics
+from protocol import EstimationTimeout, WorkersUnavailable, json_dumps, json_loads
+import reducer
+import remote
+import scheduler
+import tracing
+import writeback
                     
 ctx = multiprocessing.get_context("forkserver")
+# Have the fork server import the estimation library (and load its reference tables)
+# once, so that every estimation worker forked from it starts out warm.
+ctx.set_forkserver_preload([__name__, "impacts_estimation.impacts_estimation"])
+
+
+def _reduce_impact(impact, impact_categories, percentiles=()):
+    """Returns the part of an estimate_impacts result that the decoration needs."""
+    return {
+            "impacts_geom_means": impact['impacts_geom_means'],
+            "decoration": reducer.decoration(impact, impact_categories, percentiles),
+    }
+
+
+# The run counts estimate_impacts uses by default.
+MIN_RUNS = 30
+MAX_RUNS = 1000
+
+
+def _estimate_within(estimate, time_budget):
+    """Runs estimate cooperatively within time_budget seconds: a first pass of
+    MIN_RUNS runs measures how long a run takes, then a second pass gets as many
+    runs as fit in the rest of the budget, up to MAX_RUNS.
+    Returns the result, and its number of runs if it was stopped by the budget
+    rather than by the convergence of the confidence interval, or else None."""
+    start = time.monotonic()
+    impact = estimate(min_run_nb=MIN_RUNS, max_run_nb=MIN_RUNS)
+    runs = len(impact['confidence_score_distribution'])
+    elapsed = time.monotonic() - start
+    affordable = MAX_RUNS
+    if elapsed > 0:
+        affordable = min(MAX_RUNS, int((time_budget - elapsed) * runs / elapsed))
+    if affordable <= runs:
+        return impact, runs
+    impact = estimate(min_run_nb=MIN_RUNS, max_run_nb=affordable)
+    runs = len(impact['confidence_score_distribution'])
+    if affordable < MAX_RUNS and runs >= affordable:
+        return impact, runs
+    return impact, None
+
+
+def _share_distributions(impact, impact_categories, name):
+    """Copies the confidence score and impact distributions of an estimate_impacts
+    result, one row each, into a new shared memory block named name, and returns
+    its name and the shape of the array in it. The receiver must unlink it."""
+    rows = [impact['confidence_score_distribution']] + [impact['impact_distributions'][c] for c in impact_categories]
+    array = np.asarray(rows, dtype=np.float64)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf)[:] = array
+    shm.close()
+    return shm.name, array.shape
+
+
+def _take_distributions(name, shape, impact_categories):
+    """Returns the distributions shared by _share_distributions, as a dict with the
+    confidence scores under "confidence_score" and an array per impact category,
+    and unlinks the shared memory block."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        array = np.ndarray(shape, dtype=np.float64, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    distributions = {"confidence_score": array[0]}
+    for idx, category in enumerate(impact_categories):
+        distributions[category] = array[idx + 1]
+    return distributions
+
+
+def _unlink_distributions(name):
+    """Unlinks the shared memory block name, if a worker created it."""
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _estimation_worker(conn, impact_categories):
+    """This function runs in a long-lived separate process, and communicates with
+    the parent through the provided connection. Once it is ready it sends the time,
+    then for every (product, options) received it must send back a tuple of
+    (result, exception-string, profile-string).
+
+    The result is reduced to what the decoration needs before being sent, and with
+    the "distributions" option the full distributions are added as the name and
+    shape of a shared memory block (named by the "shared_name" option), so they
+    don't need to be pickled."""
+    try:
+        from impacts_estimation.impacts_estimation import estimate_impacts
+        import_error = None
+    except Exception as e:
+        import_error = f"{e.__class__.__name__}: {e}"
+    conn.send(time.time())
+    while True:
+        try:
+            product, options = conn.recv()
+        except EOFError:
+            return
+        if import_error:
+            conn.send((None, import_error, None))
+            continue
+        profiler = None
+        if options.get("profile_threshold") is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.monotonic()
+        try:
+            def estimate(**kwargs):
+                return estimate_impacts(
+                        ignore_unknown_ingredients=False,
+                        product=product,
+                        distributions_as_result=True,
+                        impact_names=impact_categories,
+                        **kwargs)
+            partial_runs = None
+            if options.get("time_budget") is None:
+                impact = estimate()
+            else:
+                impact, partial_runs = _estimate_within(estimate, options["time_budget"])
+            reduced = _reduce_impact(impact, impact_categories, options.get("percentiles", ()))
+            if partial_runs is not None:
+                reduced["partial_runs"] = partial_runs
+                reduced["decoration"]["impact"]["warnings"] = list(reduced["decoration"]["impact"]["warnings"]) + [
+                        f"The estimation was stopped after {partial_runs} runs to stay within its time budget"]
+            if options.get("distributions"):
+                reduced["shared_distributions"] = _share_distributions(impact, impact_categories, options["shared_name"])
+            results = (reduced, None)
+        except Exception as e:
+            results = (None, f"{e.__class__.__name__}: {e}")
+        profile = None
+        if profiler is not None:
+            profiler.disable()
+            if time.monotonic() - start > options["profile_threshold"]:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+                profile = out.getvalue()
+        conn.send(results + (profile,))
+
+
+_BSON_KEY = re.compile(r'[^:-_a-zA-Z0-9]')
+_NATIVE_TYPES = frozenset([str, int, float, bool, type(None)])
+_CONTAINER_TYPES = frozenset([dict, list, tuple])
+_KEY_CACHE_SIZE = 1 << 16
+_key_cache = {}
+
+
+def _sanitize_key(k):
+    sanitized = _key_cache.get(k)
+    if sanitized is None:
+        if len(_key_cache) >= _KEY_CACHE_SIZE:
+            _key_cache.clear()
+        sanitized = _BSON_KEY.sub('_', k)
+        _key_cache[k] = sanitized
+    return sanitized
+
+
+_leaf_converters = {}
+
+
+def _leaf_converter(t):
+    """Returns the function converting values of type t to native Python values,
+    or None if they are left as they are."""
+    if t not in _leaf_converters:
+        converter = None
+        if issubclass(t, np.bool_):
+            converter = bool
+        elif issubclass(t, np.integer):
+            converter = int
+        elif issubclass(t, np.floating):
+            converter = float
+        elif issubclass(t, (np.generic, np.ndarray)):
+            converter = lambda v: v.tolist()
+        _leaf_converters[t] = converter
+    return _leaf_converters[t]
+
+
+def _sanitize_leaf(v):
+    converter = _leaf_converter(type(v))
+    if converter is None:
+        return v
+    return converter(v)
+
+
+class _Frame:
+    """A container being walked by sanitize, with an iterator over its (key, value)
+    pairs or values, the sanitized keys and values so far, and whether anything
+    changed."""
+    __slots__ = ["container", "items", "keys", "values", "changed"]
+
+    def __init__(self, m):
+        self.container = m
+        self.values = []
+        if isinstance(m, dict):
+            self.items = iter(m.items())
+            self.keys = []
+            self.changed = type(m) is not dict
+        else:
+            self.items = iter(m)
+            self.keys = None
+            self.changed = type(m) is not list and type(m) is not tuple
+
+
+def sanitize(m):
+    """Returns m with dict keys made safe to store in MongoDB, and NumPy scalars
+    and arrays converted to native Python values.
+
+    Key characters outside of [:-_a-zA-Z0-9] are replaced by '_'. Note that :-_
+    is the range from ':' to '_', which also keeps ;<=>?@[\\]^ and the
+    uppercase letters: this is what _bsonify always did, and is kept so that
+    stored keys don't change.
+
+    The walk uses an explicit stack instead of recursion, key translations are
+    cached, and dicts, lists and tuples that need no change are returned as is
+    rather than copied."""
+    if not isinstance(m, (dict, list, tuple)):
+        return _sanitize_leaf(m)
+    stack = [_Frame(m)]
+    while True:
+        frame = stack[-1]
+        keys = frame.keys
+        values = frame.values
+        for item in frame.items:
+            if keys is not None:
+                k, v = item
+                sanitized_key = _sanitize_key(k)
+                if sanitized_key != k:
+                    frame.changed = True
+                keys.append(sanitized_key)
+            else:
+                v = item
+            t = type(v)
+            if t in _NATIVE_TYPES:
+                values.append(v)
+            elif t in _CONTAINER_TYPES or isinstance(v, (dict, list, tuple)):
+                stack.append(_Frame(v))
+                break
+            else:
+                converter = _leaf_converters.get(t) or _leaf_converter(t)
+                if converter is None:
+                    values.append(v)
+                else:
+                    frame.changed = True
+                    values.append(converter(v))
+        else:
+            stack.pop()
+            container = frame.container
+            if not frame.changed:
+                result = container
+            elif keys is not None:
+                result = dict(zip(keys, values))
+            elif isinstance(container, tuple):
+                result = tuple(values)
+            else:
+                result = values
+            if len(stack) == 0:
+                return result
+            parent = stack[-1]
+            if result is not container:
+                parent.changed = True
+            parent.values.append(result)
+
+
+DEFAULT_IMPACT_CATEGORIES = ["EF single score", "Climate change"]
+
+
+def parse_impact_categories(value):
+    """Parses a comma separated list of impact category names, like "EF single score,Climate change"."""
+    categories = [category.strip() for category in value.split(",") if category.strip() != ""]
+    if len(categories) == 0:
+        raise ValueError("no impact categories")
+    return categories
+
+
+def shard_of(code, shard_count):
+    """Returns the shard of the product with code, the same in every replica."""
+    return zlib.crc32(str(code).encode("utf-8")) % shard_count
+
+
+def parse_percentiles(value):
+    """Parses a comma separated list of percentiles, like "5,50,95"."""
+    percentiles = tuple(float(q) for q in value.split(",") if q.strip() != "")
+    for q in percentiles:
+        if q < 0 or q > 100:
+            raise ValueError(f"percentile {q} is not between 0 and 100")
+    return percentiles
+
+
+class EstimatorPool:
+    """Keeps a number of pre-warmed estimation processes running, and hands products
+    to them one at a time. A process that overruns its deadline (or dies) is killed
+    and replaced, the others are reused for the next products."""
+
+    def __init__(self, size, impact_categories, logging=logging.getLogger("uvicorn.info"), metrics=None, spans=None, percentiles=()):
+        self.size = size
+        # Percentiles of the impact distributions to add to the decorations.
+        self.percentiles = tuple(percentiles)
+        self.spans = spans or tracing.Spans()
+        # Estimations running longer than this are profiled, if not None.
+        self.profile_threshold = None
+        self.impact_categories = impact_categories
+        self.logging = logging
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._spawned_at = {}
+        self._shared_names = itertools.count()
+        self._started = False
+        self.running = 0
+        self._startup_seconds = None
+        if metrics is not None:
+            self._startup_seconds = metrics.histogram("worker_startup_seconds", "Time from forking an estimation worker until it is ready.")
+            metrics.gauge("estimations_running", "Number of estimations running in the worker processes.", lambda: self.running)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                self._idle.put(self._spawn())
+            self._started = True
+
+    def close(self):
+        with self._lock:
+            for worker in list(self._workers):
+                self._retire(worker)
+            self._idle = queue.Queue()
+            self._started = False
+
+    def _spawn(self):
+        parent_conn, child_conn = ctx.Pipe()
+        p = ctx.Process(target=_estimation_worker, args=(child_conn, self.impact_categories))
+        p.daemon = True
+        p.start()
+        child_conn.close()
+        self.logging.info(f"🍴 Forked {p.pid} as estimation worker")
+        worker = (p, parent_conn)
+        self._workers.add(worker)
+        self._spawned_at[worker] = time.time()
+        return worker
+
+    def _retire(self, worker):
+        p, conn = worker
+        self._workers.discard(worker)
+        self._spawned_at.pop(worker, None)
+        conn.close()
+        p.kill()
+        p.join()
+        p.close()
+
+    def _receive(self, worker, timeout, deadline, stage):
+        p, conn = worker
+        ready = multiprocessing.connection.wait([conn, p.sentinel], timeout=timeout)
+        if conn not in ready:
+            if p.sentinel in ready:
+                raise Exception(f"estimation process {p.pid} died with exit code {p.exitcode}")
+            raise EstimationTimeout(stage, deadline)
+        return conn.recv()
+
+    def wait_ready(self, timeout=600):
+        """Starts the processes, and blocks until they are all ready to estimate."""
+        self.start()
+        workers = [self._idle.get() for _ in range(self.size)]
+        try:
+            for worker in workers:
+                if worker in self._spawned_at:
+                    ready_at = self._receive(worker, timeout, timeout, "startup")
+                    startup = ready_at - self._spawned_at.pop(worker)
+                    if self._startup_seconds is not None:
+                        self._startup_seconds.observe(startup)
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def estimate(self, product, deadline=600, distributions=False, time_budget=None):
+        """Runs the estimation of product in one of the pooled processes, and returns
+        the reduced result of the worker, with the full distributions under
+        "distributions" if requested, and the seconds it took under "seconds".
+        With a time_budget the worker stops early, with a partial result, to
+        stay within that many seconds (and within the deadline).
+        The process can time out, or die, and both need to provide exceptions in
+        addition to anything received via the connection.
+        A process that has just been forked counts its startup in the deadline.
+        The shared memory block of the distributions is named here, so that it can
+        be unlinked even when they don't make it into the result."""
+        self.start()
+        code = product.get("code")
+        shared_name = None
+        if distributions:
+            shared_name = f"ie_{os.getpid()}_{next(self._shared_names)}"
+        with self.spans.span("worker_wait", code):
+            worker = self._idle.get()
+        start = time.monotonic()
+        p, conn = worker
+        healthy = False
+        with self._lock:
+            self.running += 1
+        try:
+            if worker in self._spawned_at:
+                with self.spans.span("worker_startup", code):
+                    ready_at = self._receive(worker, deadline, deadline, "startup")
+                startup = ready_at - self._spawned_at.pop(worker)
+                if self._startup_seconds is not None:
+                    self._startup_seconds.observe(startup)
+            with self.spans.span("estimation", code) as attributes:
+                sent = time.monotonic()
+                remaining = max(0, deadline - (sent - start))
+                if time_budget is not None:
+                    time_budget = min(time_budget, 0.9 * remaining)
+                conn.send((product, {
+                    "profile_threshold": self.profile_threshold,
+                    "distributions": distributions,
+                    "shared_name": shared_name,
+                    "percentiles": self.percentiles,
+                    "time_budget": time_budget,
+                    }))
+                results = self._receive(worker, remaining, deadline, "estimation")
+                healthy = True
+                result = results[0]
+                if result is not None and "shared_distributions" in result:
+                    name, shape = result.pop("shared_distributions")
+                    result["distributions"] = _take_distributions(name, shape, self.impact_categories)
+                    shared_name = None
+                if results[2] is not None:
+                    attributes["profile"] = results[2]
+                if results[1]:
+                    raise Exception(f"estimation process got exception: {results[1]}")
+            result["seconds"] = time.monotonic() - sent
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+            if not healthy:
+                self.logging.info(f"🔪 Replacing estimation worker {p.pid}")
+                with self._lock:
+                    self._retire(worker)
+                    worker = self._spawn()
+            if shared_name is not None:
+                # The worker may have shared the distributions before it timed out.
+                _unlink_distributions(shared_name)
+            self._idle.put(worker)
+
+
+class Backoff:
+    """Exponentially growing delays between minimum and maximum seconds, with
+    some random jitter so that several replicas don't poll in lockstep."""
+
+    def __init__(self, minimum=5, maximum=600, factor=2, jitter=0.2):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.current = 0
+
+    def reset(self):
+        self.current = 0
+
+    def next(self):
+        if self.current == 0:
+            self.current = self.minimum
+        else:
+            self.current = min(self.maximum, self.current * self.factor)
+        return self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class ErrorStats:
+    """Counts errors by class, where the class is the error string with the product
+    specific details (numbers, quoted strings, URLs, response bodies) normalized
+    away. Only the max_classes most frequent classes are kept, plus the last
+    max_recent raw errors, so memory use is bounded however long the server runs."""
+
+    _normalizations = [
+            (re.compile(r"https?://\S+"), "<url>"),
+            (re.compile(r"'[^']*'|\"[^\"]*\""), "<str>"),
+            (re.compile(r"\{.*\}"), "<json>"),
+            (re.compile(r"\d+\.\d+|\d{4,}"), "<n>"),
+            (re.compile(r"\s+"), " "),
+            ]
+
+    def __init__(self, max_classes=50, max_recent=20, max_length=200):
+        self.max_classes = max_classes
+        self.max_length = max_length
+        self.total = 0
+        self._counts = {}
+        self._recent = collections.deque(maxlen=max_recent)
+        self._lock = threading.Lock()
+
+    def normalize(self, s):
+        s = s[:10 * self.max_length]
+        for pattern, replacement in self._normalizations:
+            s = pattern.sub(replacement, s)
+        return s.strip()[:self.max_length]
+
+    def add(self, s):
+        error_class = self.normalize(s)
+        with self._lock:
+            self.total += 1
+            self._recent.append({"time": time.time(), "error": s[:self.max_length]})
+            if error_class in self._counts:
+                self._counts[error_class] += 1
+            elif len(self._counts) < self.max_classes:
+                self._counts[error_class] = 1
+            else:
+                # Replace the least frequent class, inheriting its count, so that
+                # frequent classes can't be pushed out by a stream of rare ones.
+                least = min(self._counts, key=self._counts.get)
+                self._counts[error_class] = self._counts.pop(least) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                    "total": self.total,
+                    "classes": dict(sorted(self._counts.items(), key=lambda item: -item[1])),
+                    "recent": list(self._recent),
+                    }
+
 
 class Server:
     def __init__(self,
@@ -20,7 +558,37 @@ class Server:
                  productopener_basic_auth_username="",
                  productopener_basic_auth_password="",
                  productopener_username=None,
-                 productopener_password=None):
+                 productopener_password=None,
+                 estimation_workers=1,
+                 estimation_concurrency=None,
+                 pipeline_depth=None,
+                 poll_backoff_min=5,
+                 poll_backoff_max=600,
+                 http_pool_size=10,
+                 http_timeout=60,
+                 http_retries=3,
+                 writeback_concurrency=0,
+                 page_size=20,
+                 search_sort_by="nothing",
+                 search_paging="first",
+                 cache_size=10000,
+                 cache_path=None,
+                 cache_disk_size=100000,
+                 journal_path=None,
+                 trace_path=None,
+                 trace_profile_threshold=None,
+                 decoration_percentiles=(),
+                 impact_categories=None,
+                 estimation_deadline=600,
+                 estimation_deadline_min=60,
+                 scheduling="cheapest_first",
+                 dedicated_estimators=0,
+                 expensive_cost=40,
+                 shard_index=0,
+                 shard_count=1,
+                 estimation_endpoints=None,
+                 estimation_endpoint_slots=1,
+                 estimation_token=None):
         self.logging = logging
         self.productopener_base_url = productopener_base_url
         self.productopener_host_header = productopener_host_header
@@ -29,9 +597,91 @@ class Server:
         self.auth = None
         if productopener_basic_auth_username != "" and productopener_basic_auth_password != "":
             self.auth = requests.auth.HTTPBasicAuth(productopener_basic_auth_username, productopener_basic_auth_password)
+        self.http_timeout = http_timeout
+        # All Product Opener traffic goes through one session, so that connections
+        # are kept alive and reused between searches and updates.
+        self._http_adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=http_pool_size,
+                max_retries=urllib3.util.retry.Retry(
+                    total=http_retries,
+                    backoff_factor=0.5,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=None,
+                    raise_on_status=False))
+        self.session = requests.Session()
+        self.session.mount("http://", self._http_adapter)
+        self.session.mount("https://", self._http_adapter)
+        self.cache = None
+        if cache_size > 0:
+            self.cache = cache.ResultCache(size=cache_size, path=cache_path, disk_size=cache_disk_size)
+        self.writeback = None
+        if writeback_concurrency > 0:
+            self.writeback = writeback.AsyncWriteback(self, writeback_concurrency, retries=http_retries)
         self.estimation_version = 4
-        self.impact_categories = ["EF single score",
-                                  "Climate change"]
+        self.journal = None
+        if journal_path:
+            self.journal = journal.Journal(journal_path, estimation_version=self.estimation_version)
+        # Part of the input fingerprint of decorations: bump it when the estimations
+        # change, so that products get estimated again even if their inputs didn't.
+        self.estimator_version = 1
+        # All categories are computed in the same estimation run, each one adds
+        # its likeliest impact and the spread of its distribution to the decoration.
+        self.impact_categories = list(impact_categories or DEFAULT_IMPACT_CATEGORIES)
+        self.metrics = metrics.Registry()
+        self.spans = tracing.Spans()
+        self.decoration_percentiles = tuple(decoration_percentiles)
+        if estimation_endpoints:
+            # Estimations run on remote workers, which must reduce them the same way.
+            self.estimator_pool = remote.RemoteEstimator(estimation_endpoints, self.impact_categories, slots=estimation_endpoint_slots, logging=logging, metrics=self.metrics, spans=self.spans, percentiles=self.decoration_percentiles, token=estimation_token)
+            estimation_workers = self.estimator_pool.size
+        else:
+            self.estimator_pool = EstimatorPool(estimation_workers, self.impact_categories, logging=logging, metrics=self.metrics, spans=self.spans, percentiles=self.decoration_percentiles)
+        if trace_path:
+            self.add_tracer(tracing.JsonlTracer(trace_path, profile_threshold=trace_profile_threshold))
+        self.deadlines = complexity.DeadlineModel(minimum=min(estimation_deadline_min, estimation_deadline), maximum=estimation_deadline)
+        self.estimation_concurrency = estimation_concurrency or estimation_workers
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise ValueError(f"shard index {shard_index} is not between 0 and shard count {shard_count}")
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.page_size = page_size
+        # Only about one in shard_count products found belong to this shard, so
+        # search pages are that much larger to keep page_size products coming.
+        self.search_page_size = page_size * shard_count
+        self.pipeline_depth = pipeline_depth or page_size
+        self.search_sort_by = search_sort_by
+        # With "first" paging the first page of the search is fetched every time,
+        # relying on decorated products dropping out of it. With "sweep" paging the
+        # pages are walked until a short one, so one sweep covers the backlog.
+        self.search_paging = search_paging
+        self._page = 1
+        self.backoff = Backoff(minimum=poll_backoff_min, maximum=poll_backoff_max)
+        self._stop = threading.Event()
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._written = threading.Condition(self._in_flight_lock)
+        # Estimator stages taking only expensive products, out of estimation_concurrency.
+        self.dedicated_estimators = max(0, min(dedicated_estimators, self.estimation_concurrency - 1))
+        self._fetched = scheduler.Scheduler(
+                self.pipeline_depth,
+                policy=scheduling,
+                expensive_cost=expensive_cost if self.dedicated_estimators > 0 else None)
+        self._estimated = queue.Queue(maxsize=self.pipeline_depth)
+        self._stats_lock = threading.Lock()
+        self._fetch_seconds = self.metrics.histogram("fetch_seconds", "Time to fetch a page of products to decorate.")
+        self._estimation_seconds = self.metrics.histogram("estimation_seconds", "Wall time of estimations, including waiting for a worker.")
+        self._fetch_queue_wait_seconds = self.metrics.histogram("fetch_queue_wait_seconds", "Time fetched products wait for an estimator.")
+        self._write_queue_wait_seconds = self.metrics.histogram("write_queue_wait_seconds", "Time decorations wait for the writer.")
+        self._writeback_seconds = self.metrics.histogram("writeback_seconds", "Time to store a decoration in productopener.")
+        self.metrics.gauge("in_flight_products", "Number of products fetched but not yet written.", lambda: len(self._in_flight))
+        self.metrics.gauge("fetch_queue_backlog", "Number of fetched products waiting for an estimator.", lambda: self._fetched.qsize())
+        self.metrics.gauge("write_queue_backlog", "Number of decorations waiting for the writer.", lambda: self._estimated.qsize())
+        self.metrics.gauge("poll_backoff_seconds", "Current delay before polling productopener again.", lambda: self.stats["poll_backoff_seconds"])
+        for name in ["seen", "estimate_impacts_success", "estimate_impacts_failure",
+                     "update_extended_data_success", "update_extended_data_failure",
+                     "cache_hits", "cache_misses", "unchanged_inputs"]:
+            self.metrics.counter(f"{name}_total", f"Number of {name.replace('_', ' ')} events.", lambda name=name: self.stats[name])
         self.stats = {
                 "status": "off",
                 "seen": 0,
@@ -39,13 +689,65 @@ class Server:
                 "estimate_impacts_failure": 0,
                 "update_extended_data_success": 0,
                 "update_extended_data_failure": 0,
-                "errors": {},
+                "cache_hits": 0,
+                "cache_misses": 0,
+                "unchanged_inputs": 0,
+                "resumed_from_journal": 0,
+                "skipped_other_shards": 0,
+                "poll_backoff_seconds": 0,
+                "search_page": 1,
+                "partial_estimations": 0,
                 }
+        # Kept apart from stats, whose values are all numbers or strings.
+        self.estimation_timeouts = {"startup": 0, "adaptive_deadline": 0, "maximum_deadline": 0, "retry": 0}
+        self.update_latency_seconds = {"count": 0, "sum": 0.0, "last": 0.0, "max": 0.0}
+        self.errors = ErrorStats()
+        self.metrics.counter("errors_total", "Number of errors.", lambda: self.errors.total)
+
+    def add_tracer(self, tracer):
+        """Adds a tracing.Tracer getting callbacks for every stage of every product."""
+        self.spans.tracers.append(tracer)
+        threshold = getattr(tracer, "profile_threshold", None)
+        if threshold is not None:
+            current = self.estimator_pool.profile_threshold
+            self.estimator_pool.profile_threshold = threshold if current is None else min(current, threshold)
 
     def _add_error(self, s):
-        if not s in self.stats["errors"]:
-            self.stats["errors"][s] = 0
-        self.stats["errors"][s] += 1
+        self.errors.add(s)
+
+    def _inc_stat(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _inc_timeouts(self, reason):
+        with self._stats_lock:
+            self.estimation_timeouts[reason] += 1
+
+    def _http_stats(self):
+        pools = self._http_adapter.poolmanager.pools
+        connections = 0
+        requests_sent = 0
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+                "http_requests": requests_sent,
+                "http_connections": connections,
+                "http_connections_reused": requests_sent - connections,
+                }
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stats["update_latency_seconds"] = dict(self.update_latency_seconds)
+            stats["estimation_timeouts"] = dict(self.estimation_timeouts)
+        stats.update(self._http_stats())
+        stats["errors"] = self.errors.snapshot()
+        return stats
+
+    def in_shard(self, prod):
+        return shard_of(prod.get("code"), self.shard_count) == self.shard_index
 
     def _prod_desc(self, prod):
         result = "(unnamed)"
@@ -60,9 +762,10 @@ class Server:
                 "api/v2/search?states_tags=en:ingredients-completed," +
                 "en:nutrition-facts-completed&" +
                 f"misc_tags=-en:ecoscore-extended-data-version-{self.estimation_version}&" +
-                "fields=code,ingredients,nutriments,product_name&" +
-                "page_size=20&" +
-                "sort_by=nothing&" +
+                "fields=code,ingredients,nutriments,product_name,ecoscore_extended_data&" +
+                f"page_size={self.search_page_size}&" +
+                f"page={self._page}&" +
+                f"sort_by={self.search_sort_by}&" +
                 "no_count=1&" +
                 "no_cache=1")
         if self.auth is not None:
@@ -72,164 +775,394 @@ class Server:
         headers = {"Accept": "application/json"}
         if self.productopener_host_header not in ["-", ""]:
             headers["Host"] = self.productopener_host_header
-        response = requests.get(url, headers=headers, auth=self.auth)
+        response = self.session.get(url, headers=headers, auth=self.auth, timeout=self.http_timeout)
         if response.status_code != 200:
             raise Exception(f"{url} -> {response.status_code}")
-        js = json.loads(response.text)
+        js = json_loads(response.content)
         return js["products"]
 
     def _bsonify(self, m):
-        if isinstance(m, dict):
-            res = {}
-            for k in m:
-                v = self._bsonify(m[k])
-                k = re.sub(r'[^:-_a-zA-Z0-9]', '_', k)
-                res[k] = v
-            return res
-        elif isinstance(m, list):
-            res = []
-            for e in m:
-                res.append(self._bsonify(e))
-            return res
-        elif isinstance(m, tuple):
-            res = []
-            for e in m:
-                res.append(self._bsonify(e))
-            return tuple(res)
-        else:
-            return m
-            
+        return sanitize(m)
 
-    def _update_product(self, prod, decoration):
-        decoration = self._bsonify(decoration)
+    def _update_request(self, prod, decoration):
+        """Returns the url, form parameters and headers used to store decoration
+        for prod."""
         url = self.productopener_base_url + "cgi/product_jqm_multilingual.pl"
         params = {
                 "user_id": self.productopener_username,
                 "password": self.productopener_password,
                 "code": prod["code"],
-                "ecoscore_extended_data": json.dumps(decoration),
+                "ecoscore_extended_data": json_dumps(decoration),
                 "ecoscore_extended_data_version": self.estimation_version,
                 }
         headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "application/json"}
         if self.productopener_host_header not in ["-", ""]:
             headers["Host"] = self.productopener_host_header
-        response = requests.post(url, data=params, headers=headers, auth=self.auth)
-        if response.status_code == 200:
+        return url, params, headers
+
+    def _check_update_response(self, prod, decoration, status_code, text):
+        if status_code == 200:
             try:
-                js = json.loads(response.text)
+                js = json_loads(text)
                 if js["status"] != 1:
-                    raise Exception(response.text)
+                    raise Exception(text)
             except json.JSONDecodeError:
-                if response.text.find("Incorrect user name or password") != -1:
+                if text.find("Incorrect user name or password") != -1:
                     raise Exception(f"Incorrect user name or password ({self.productopener_username}/{self.productopener_password[:2]}...)")
                 else:
                     raise Exception("Response not valid JSON!")
         else:
-            self.logging.info(f"Storing decoration for {self._prod_desc(prod)}: {response.text}")
+            self.logging.info(f"Storing decoration for {self._prod_desc(prod)}: {text}")
             self.logging.info(f"Problematic decoration: {decoration}")
-            raise Exception(f"Status {response.status_code}")
+            raise Exception(f"Status {status_code}")
+
+    def _sanitize(self, prod, decoration):
+        with self.spans.span("bsonify", prod.get("code")):
+            return self._bsonify(decoration)
+
+    def _update_product(self, prod, decoration):
+        decoration = self._sanitize(prod, decoration)
+        url, params, headers = self._update_request(prod, decoration)
+        response = self.session.post(url, data=params, headers=headers, auth=self.auth, timeout=self.http_timeout)
+        self._check_update_response(prod, decoration, response.status_code, response.text)
 
     def stop_update_loop(self):
         self.stats["status"] = "stopping"
+        self._stop.set()
+        with self._written:
+            self._written.notify_all()
 
     def start_update_loop(self):
+        self._stop.clear()
         thread = threading.Thread(target=self._run_update_loop, args=())
         thread.daemon = True
         thread.start()
 
-    def _estimate_outside_process(self, product, queue):
-        """This function runs in a separate process, and communicates with the parent
-        through the provided queue. The queue must get a tuple of (result, exception-string)
-        when this function terminates."""
+    def _estimate_with_deadline(self, product, deadline=None):
+        """This function runs the estimation of product in one of the pooled
+        estimation processes, which gets replaced if it doesn't produce a result
+        within deadline seconds.
+
+        Without a deadline, it is derived from the cost of the product and the
+        time recent estimations took. Products expected to overrun it, and those
+        that overran a derived deadline shorter than the maximum, are estimated
+        within a time budget instead, and may get a partial result. The retry of
+        those that overran only gets what is left of the maximum deadline, and
+        doesn't happen when that is less than the minimum deadline."""
+        cost = complexity.cost(product)
+        if deadline is None:
+            deadline = self.deadlines.deadline(cost)
+        expected = self.deadlines.expected_seconds(cost)
+        time_budget = None
+        if expected is not None and expected > 0.8 * deadline:
+            time_budget = 0.8 * deadline
+        try:
+            result = self.estimator_pool.estimate(product, deadline=deadline, time_budget=time_budget)
+        except EstimationTimeout as e:
+            if e.stage == "startup":
+                reason = "startup"
+            elif deadline < self.deadlines.maximum:
+                reason = "adaptive_deadline"
+            else:
+                reason = "maximum_deadline"
+            self._inc_timeouts(reason)
+            remaining = self.deadlines.maximum - deadline
+            if reason != "adaptive_deadline" or time_budget is not None or remaining < self.deadlines.minimum:
+                raise
+            self.logging.info(f"⏰ Estimating {self._prod_desc(product)} again within a time budget of the {remaining:.0f}s left after it overran {deadline:.0f}s")
+            try:
+                result = self.estimator_pool.estimate(product, deadline=remaining, time_budget=0.8 * remaining)
+            except EstimationTimeout:
+                self._inc_timeouts("retry")
+                raise
+        if "partial_runs" in result:
+            self._inc_stat("partial_estimations")
+        else:
+            self.deadlines.observe(cost, result["seconds"])
+        return result
+
+    def _decorate(self, prod):
+        with self.spans.span("estimate", prod.get("code")):
+            return self._decorate_product(prod)
+
+    def _decorate_product(self, prod):
+        decoration = {}
+        fingerprint = cache.input_fingerprint(prod, self.estimator_version, self.impact_categories, self.decoration_percentiles)
+        # Not needed by the estimation, so it isn't sent to the workers.
+        previous = prod.pop("ecoscore_extended_data", None)
+        if isinstance(previous, dict) and previous.get("input_fingerprint") == fingerprint and "impact" in previous:
+            self.logging.info(f"❤️  Reusing the previous estimation of unchanged {self._prod_desc(prod)}")
+            self._inc_stat("unchanged_inputs")
+            self._inc_stat("estimate_impacts_success")
+            return previous
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(fingerprint, self.estimation_version)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.logging.info(f"❤️  Reusing cached estimation for {self._prod_desc(prod)}")
+                self._inc_stat("cache_hits")
+                self._inc_stat("estimate_impacts_success")
+                return cached
+            self._inc_stat("cache_misses")
+        try:
+            start = time.monotonic()
+            try:
+                impact = self._estimate_with_deadline(prod)
+            finally:
+                self._estimation_seconds.observe(time.monotonic() - start)
+            self.logging.info(f"❤️  Computed {impact['impacts_geom_means']}") 
+            decoration = impact["decoration"]
+            self._inc_stat("estimate_impacts_success")
+            # Partial results could be improved on by a later estimation.
+            if "partial_runs" not in impact:
+                decoration["input_fingerprint"] = fingerprint
+                if cache_key is not None:
+                    self.cache.put(cache_key, decoration)
+        except WorkersUnavailable:
+            # Not the product's fault, so nothing is written for it.
+            raise
+        except Exception as e:
+            error_desc = f"{e.__class__.__name__}: {e}"
+            self.logging.info(f"💀 get_impact([{self._prod_desc(prod)}]): {error_desc}")
+            decoration["error"] = error_desc
+            self._inc_stat("estimate_impacts_failure")
+            self._add_error(error_desc)
+        return decoration
+
+    def _store(self, prod, decoration):
+        start = time.monotonic()
+        error = None
         try:
-            from impacts_estimation.impacts_estimation import estimate_impacts
-            impact = estimate_impacts(
-                    ignore_unknown_ingredients=False,
-                    product=product,
-                    distributions_as_result=True,
-                    impact_names=self.impact_categories)
-            queue.put((impact, None))
+            with self.spans.span("write", prod.get("code")):
+                self._update_product(prod, decoration)
         except Exception as e:
-            queue.put((None, f"{e.__class__.__name__}: {e}"))
-
-    def _estimate_with_deadline(self, product, deadline=600):
-        """This function starts _estimate_outside_process in a separate process, giving
-        it a queue to return a (result, exception-string) through.
-        The process can time out, and the queue can be empty - both need to provide
-        exceptions in addition to anything received via the queue."""
-        q = ctx.Queue(1)
-        p = ctx.Process(target=self._estimate_outside_process, args=(product, q))
-        results = (None, "no results yet")
+            error = e
+        self._stored(prod, error, time.monotonic() - start)
+
+    def _stored(self, prod, e, seconds):
+        """Records the outcome of storing the decoration of prod, which took
+        seconds and failed with e unless it is None."""
+        self._writeback_seconds.observe(seconds)
+        with self._stats_lock:
+            self.update_latency_seconds["count"] += 1
+            self.update_latency_seconds["sum"] += seconds
+            self.update_latency_seconds["last"] = seconds
+            self.update_latency_seconds["max"] = max(seconds, self.update_latency_seconds["max"])
+        if e is None:
+            self.logging.info(f"❤️  Stored decoration for {self._prod_desc(prod)} in {seconds:.2f}s")
+            self._inc_stat("update_extended_data_success")
+            self._record(prod, "written")
+        else:
+            error_desc = f"{e.__class__.__name__}: {e}"
+            self.logging.info(f"💀 update_product(...): {error_desc}")
+            self._inc_stat("update_extended_data_failure")
+            self._add_error(error_desc)
+        self._release(prod)
+
+    def _record(self, prod, state, decoration=None):
+        """Records the state of prod in the journal, if there is one. The journal
+        only saves work after a restart, so failing to write it is logged and
+        doesn't stop prod from going through."""
+        if self.journal is None:
+            return
+        try:
+            self.journal.record(prod, state, decoration=decoration)
+        except Exception as e:
+            error_desc = f"{e.__class__.__name__}: {e}"
+            self.logging.info(f"💀 journal.record([{self._prod_desc(prod)}], {state}): {error_desc}")
+            self._add_error(error_desc)
+
+    def _release(self, prod):
+        """Lets the fetcher hand out prod again, and wakes it up."""
+        with self._written:
+            self._in_flight.discard(prod.get("code"))
+            self._written.notify_all()
+
+    def _run_estimator_stage(self, dedicated=False):
+        """Takes products from the fetch queue, and hands their decorations to the
+        write queue. Several of these run concurrently, so several estimations can be
+        in flight at once, and dedicated ones only take expensive products.
+        A None product means the fetcher has stopped, and this stage then hands a
+        None to the writer, whatever happened before."""
         try:
-            p.start()
-            self.logging.info(f"🍴 Forked {p.pid} to compute estimation")
+            while True:
+                item = self._fetched.get(dedicated)
+                if item is None:
+                    return
+                enqueued_at, prod = item
+                try:
+                    self._fetch_queue_wait_seconds.observe(time.monotonic() - enqueued_at)
+                    self._inc_stat("seen")
+                    self.logging.info(f"Looking at {self._prod_desc(prod)}")
+                    decoration = self._decorate(prod)
+                    self._record(prod, "estimated", decoration=decoration)
+                    self._estimated.put((time.monotonic(), prod, decoration))
+                except Exception as e:
+                    # The product will be found by the search again.
+                    error_desc = f"{e.__class__.__name__}: {e}"
+                    self.logging.info(f"💀 decorate([{self._prod_desc(prod)}]): {error_desc}")
+                    self._inc_stat("estimate_impacts_failure")
+                    self._add_error(error_desc)
+                    self._release(prod)
+        finally:
+            self._estimated.put(None)
+
+    def _run_writer_stage(self):
+        """Stores the decorations from the write queue, until all estimator stages
+        have stopped. With an asynchronous write-back client, all decorations
+        waiting in the queue are handed over to it at once, and the writes happen
+        concurrently in its event loop."""
+        running = self.estimation_concurrency
+        while running > 0:
+            batch = [self._estimated.get()]
+            if self.writeback is not None:
+                while len(batch) < self.pipeline_depth:
+                    try:
+                        batch.append(self._estimated.get_nowait())
+                    except queue.Empty:
+                        break
+            for item in batch:
+                if item is None:
+                    running -= 1
+                    continue
+                enqueued_at, prod, decoration = item
+                self._write_queue_wait_seconds.observe(time.monotonic() - enqueued_at)
+                if self.writeback is not None:
+                    self.writeback.submit(prod, self._sanitize(prod, decoration))
+                else:
+                    self._store(prod, decoration)
+        if self.writeback is not None:
+            self.writeback.drain()
+
+    def _sleep(self, delay):
+        with self._stats_lock:
+            self.stats["poll_backoff_seconds"] = delay
+        self._stop.wait(delay)
+
+    def _resume_journal(self):
+        """Hands the decorations that were computed, but not written, before the
+        last restart straight to the writer stage."""
+        resumed = self.journal.take_estimated()
+        if len(resumed) > 0:
+            self.logging.info(f"❤️  Resuming {len(resumed)} estimated products from the journal")
+        for prod, decoration in resumed:
+            with self._in_flight_lock:
+                if prod.get("code") in self._in_flight:
+                    continue
+                self._in_flight.add(prod.get("code"))
+            self._inc_stat("resumed_from_journal")
+            self._estimated.put((time.monotonic(), prod, decoration))
+
+    def _run_fetcher_stage(self):
+        """Fetches pages of products to decorate into the fetch queue. Since the
+        queue is bounded, this blocks while the estimators are busy, keeping
+        at most one page fetched ahead.
+        A full page means there is a backlog, so the next page is fetched right
+        away when sweeping, and once at most half a page of products is in flight
+        when always fetching the first page. Empty pages and errors make the fetcher back off exponentially.
+        Decorated products drop out of the search, so a sweep can skip some
+        products, which are picked up by the next one.
+        With several shards, only the products of this one are kept, and pages
+        are fetched past the first one while it has nothing new for this shard."""
+        while self.stats["status"] == "on":
             try:
-                results = q.get(block=True, timeout=deadline)
-                if results[1]:
-                    raise Exception(f"estimation process got exception: {results[1]}")
-                return results[0]
-            except queue.Empty:
-                raise Exception(f"estimation process timed out after {deadline} seconds")
+                start = time.monotonic()
+                try:
+                    with self.spans.span("fetch"):
+                        products = self._get_products()
+                finally:
+                    self._fetch_seconds.observe(time.monotonic() - start)
+                found = len(products)
+                full = found == self.search_page_size
+                if self.shard_count > 1:
+                    mine = [prod for prod in products if self.in_shard(prod)]
+                    with self._stats_lock:
+                        self.stats["skipped_other_shards"] += found - len(mine)
+                    products = mine
+                self.logging.info(f"❤️  Found {len(products)} products to decorate")
+                added = 0
+                for prod in products:
+                    with self._in_flight_lock:
+                        # Products still being estimated or stored are returned by
+                        # the search until their decoration is written.
+                        if prod.get("code") in self._in_flight:
+                            continue
+                        self._in_flight.add(prod.get("code"))
+                    self._record(prod, "fetched")
+                    self._fetched.put((time.monotonic(), prod), complexity.cost(prod))
+                    added += 1
+                page = self._page
+                if self.search_paging == "sweep":
+                    self._page = page + 1 if full else 1
+                elif self.shard_count > 1:
+                    # The first pages can be full of products of other shards, whose
+                    # replicas are behind, so look further until something is added.
+                    self._page = page + 1 if full and added == 0 else 1
+                with self._stats_lock:
+                    self.stats["search_page"] = self._page
+                if found == 0 and page > 1 and self.search_paging == "sweep":
+                    # The end of a sweep, start over from the first page.
+                    self._sleep(0)
+                elif found == 0 and page == 1:
+                    self._sleep(self.backoff.next())
+                elif self._page > page:
+                    self.backoff.reset()
+                    self._sleep(0)
+                elif full and self.search_paging == "first":
+                    # The first page keeps returning the products in flight until
+                    # they are written, so searching again right away would mostly
+                    # find those again.
+                    self.backoff.reset()
+                    self._wait_for_room()
+                elif added == 0:
+                    # Everything found is already in flight (or, past the first page,
+                    # belongs to other shards), so wait for something to be written
+                    # before searching again.
+                    with self._written:
+                        self._written.wait(self.backoff.minimum)
+                elif found < self.search_page_size:
+                    self.backoff.reset()
+                    self._sleep(self.backoff.minimum)
+                else:
+                    self.backoff.reset()
+                    self._sleep(0)
             except Exception as e:
-                raise Exception(f"estimation queue read: {e.__class__.__name__}: {e}")
-        finally:
-            p.kill()
-            p.join()
-            p.close()
+                delay = self.backoff.next()
+                self.logging.info(f"💀 update loop got error: {e}\nSleeping {delay:.0f} seconds and retrying.")
+                self._sleep(delay)
 
+    def _wait_for_room(self):
+        """Blocks until at most half a page of products is in flight, or the update
+        loop is stopping."""
+        with self._written:
+            while len(self._in_flight) > self.page_size // 2 and not self._stop.is_set():
+                self._written.wait()
 
     def _run_update_loop(self):
         self.stats["status"] = "on"
+        stages = [threading.Thread(target=self._run_writer_stage, args=(), daemon=True)]
+        for idx in range(self.estimation_concurrency):
+            dedicated = idx < self.dedicated_estimators
+            stages.append(threading.Thread(target=self._run_estimator_stage, args=(dedicated,), daemon=True))
+        self._fetched.open()
         try:
-            self.logging.info("run_update_loop()")
-            while self.stats["status"] == "on":
-                try:
-                    products = self._get_products()
-                    self.logging.info(f"❤️  Found {len(products)} products to decorate")
-                    for prod in products:
-                        self.stats["seen"] += 1
-                        self.logging.info(f"Looking at {self._prod_desc(prod)}")
-                        decoration = {}
-                        try:
-                            impact = self._estimate_with_deadline(prod)
-                            self.logging.info(f"❤️  Computed {impact['impacts_geom_means']}") 
-                            max_confidence_idx = np.argmax(impact['confidence_score_distribution'])
-                            decoration["impact"] = {
-                                    "likeliest_recipe": impact['recipes'][max_confidence_idx],
-                                    "likeliest_impacts": {
-                                        "Climate change": impact['impact_distributions']['Climate change'][max_confidence_idx],
-                                        "EF single score": impact['impact_distributions']['EF single score'][max_confidence_idx],
-                                    },
-                                    "ef_single_score_log_stddev": np.std(np.log(impact['impact_distributions']['EF single score'])),
-                                    "mass_ratio_uncharacterized": impact['uncharacterized_ingredients_mass_proportion']['impact'],
-                                    "uncharacterized_ingredients": impact['uncharacterized_ingredients'],
-                                    "uncharacterized_ingredients_mass_proportion": impact['uncharacterized_ingredients_mass_proportion'],
-                                    "uncharacterized_ingredients_ratio": impact['uncharacterized_ingredients_ratio'],
-                                    "warnings": impact['warnings'],
-                            }
-                            self.stats["estimate_impacts_success"] += 1
-                        except Exception as e:
-                            error_desc = f"{e.__class__.__name__}: {e}"
-                            self.logging.info(f"💀 get_impact([{self._prod_desc(prod)}]): {error_desc}")
-                            decoration["error"] = error_desc
-                            self.stats["estimate_impacts_failure"] += 1
-                            self._add_error(error_desc)
-                        try:
-                            self._update_product(prod, decoration)
-                            self.logging.info(f"❤️  Stored decoration for {self._prod_desc(prod)}")
-                            self.stats["update_extended_data_success"] += 1
-                        except Exception as e:
-                            error_desc = f"{e.__class__.__name__}: {e}"
-                            self.logging.info(f"💀 update_product(...): {error_desc}")
-                            self.stats["update_extended_data_failure"] += 1
-                            self._add_error(error_desc)
-                    time.sleep(30)
-                except Exception as e:
-                    self.logging.info(f"💀 update loop got error: {e}\nSleeping a few minutes and retrying.")
-                    time.sleep(600)
+            self.logging.info(f"run_update_loop() with {self.estimation_concurrency} concurrent estimations, {self.dedicated_estimators} of them for expensive products")
+            if self.writeback is not None:
+                self.writeback.start()
+            for stage in stages:
+                stage.start()
+            if self.journal is not None:
+                self._resume_journal()
+            self._run_fetcher_stage()
         except Exception as e:
             self.logging.info(f"💀 update loop terminates: {e}")
         finally:
+            self._fetched.close()
+            for stage in stages:
+                if stage.is_alive():
+                    stage.join()
+            if self.writeback is not None:
+                self.writeback.close()
+            self.estimator_pool.close()
             self.stats["status"] = "off"
-
-
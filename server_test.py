@@ -1,4 +1,5 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
 import uvicorn
 import unittest
@@ -6,8 +7,25 @@ import threading
 import time
 import logging
 import requests
+import copy
+import json
+import os
+import glob
+import sqlite3
+import tempfile
+import numpy as np
 
+import batch
+import cache
+import complexity
+import journal
+import reducer
+import remote
+import scheduler
 import server
+import simulator
+import throughput_benchmark
+import tracing
 
 
 mock = FastAPI()
@@ -15,6 +33,7 @@ mock = FastAPI()
 logging=logging.getLogger("uvicorn.info")
 
 search_responses = []
+searched_pages = []
 updated_products = []
 expected_host_header = "a_host_header"
 expected_username = "a_username"
@@ -24,8 +43,10 @@ expected_password = "a_password"
 def api_v2_search(request: Request):
     global expected_host_header
     global search_responses
+    global searched_pages
     if request.headers["host"] != expected_host_header:
         raise Exception("Wrong host header")
+    searched_pages.append(request.query_params["page"])
     if len(search_responses) == 0:
         return {
                 "products": [],
@@ -63,17 +84,7 @@ async def product_jqm_multilingual(request: Request):
 def started():
     return True
 
-class TestServer(unittest.TestCase):
-
-    def testUpdateLoop(self):
-        global search_responses
-        global updated_products
-        serv = server.Server(
-                productopener_base_url="http://localhost:8000/",
-                productopener_host_header=expected_host_header,
-                productopener_username=expected_username,
-                productopener_password=expected_password)
-        search_responses = [[
+PRODUCTS = [
 	{
 		"code": "3920291118574",
 		"ingredients": [
@@ -739,19 +750,530 @@ class TestServer(unittest.TestCase):
 			"sugars_value": 0.7
 		},
 		"product_name": "Chips paysannes nature"
-	}]]
+	}]
+
+class TestServer(unittest.TestCase):
+
+    def _checkUpdateLoop(self, serv, page_size=None):
+        global search_responses
+        global searched_pages
+        global updated_products
+        updated_products = []
+        searched_pages = []
+        if page_size is None:
+            search_responses = [copy.deepcopy(PRODUCTS)]
+        else:
+            search_responses = [copy.deepcopy(PRODUCTS[i:i+page_size]) for i in range(0, len(PRODUCTS), page_size)]
         product_codes = {}
-        for prod in search_responses[0]:
+        for prod in PRODUCTS:
             product_codes[prod["code"]] = True
-        num_products = len(search_responses[0])
+        num_products = len(PRODUCTS)
         serv.start_update_loop()
         while len(updated_products) < num_products:
             time.sleep(0.2)
         serv.stop_update_loop()
+        while serv.stats["status"] != "off":
+            time.sleep(0.2)
         for code in updated_products:
             del(product_codes[code])
         assert(len(product_codes) == 0)
 
+    def testUpdateLoop(self):
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password)
+        self._checkUpdateLoop(serv)
+        assert(serv.get_stats()["http_connections_reused"] > 0)
+        assert(f"impactestimator_writeback_seconds_count {len(PRODUCTS)}\n" in serv.metrics.render())
+
+    def testEstimatorStageError(self):
+        global search_responses
+        global updated_products
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password)
+        decorate = serv._decorate
+        def failing_decorate(prod):
+            if prod["code"] == PRODUCTS[0]["code"]:
+                raise Exception("an error outside of the estimation")
+            return decorate(prod)
+        serv._decorate = failing_decorate
+        updated_products = []
+        search_responses = [copy.deepcopy(PRODUCTS)]
+        serv.start_update_loop()
+        while len(updated_products) < len(PRODUCTS) - 1:
+            time.sleep(0.2)
+        serv.stop_update_loop()
+        while serv.stats["status"] != "off":
+            time.sleep(0.2)
+        assert(PRODUCTS[0]["code"] not in updated_products)
+        assert(serv._in_flight == set())
+        assert(serv.get_stats()["errors"]["total"] >= 1)
+
+    def testParallelUpdateLoop(self):
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password,
+                estimation_workers=3,
+                dedicated_estimators=1,
+                expensive_cost=3)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.jsonl")
+            serv.add_tracer(tracing.JsonlTracer(path))
+            self._checkUpdateLoop(serv)
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+        for prod in PRODUCTS:
+            stages = set([span["stage"] for span in spans if span["code"] == prod["code"]])
+            assert(stages.issuperset(["estimate", "worker_wait", "estimation", "bsonify", "write"]))
+
+    def testAsyncWritebackUpdateLoop(self):
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password,
+                estimation_workers=2,
+                writeback_concurrency=4)
+        self._checkUpdateLoop(serv)
+
+    def testSweepingUpdateLoop(self):
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password,
+                page_size=2,
+                search_paging="sweep")
+        self._checkUpdateLoop(serv, page_size=2)
+        assert(searched_pages[:3] == ["1", "2", "3"])
+
+    def testBackoff(self):
+        backoff = server.Backoff(minimum=1, maximum=10, jitter=0)
+        assert(backoff.next() == 1)
+        assert(backoff.next() == 2)
+        for _ in range(10):
+            backoff.next()
+        assert(backoff.next() == 10)
+        backoff.reset()
+        assert(backoff.next() == 1)
+
+
+    def testSharedDistributions(self):
+        impact = {
+                "confidence_score_distribution": [0.1, 0.7, 0.2],
+                "impact_distributions": {
+                    "EF single score": [1.0, 2.0, 4.0],
+                    "Climate change": [3.0, 5.0, 7.0],
+                    },
+                }
+        name, shape = server._share_distributions(impact, ["EF single score", "Climate change"], f"ie_test_{os.getpid()}")
+        assert(shape == (3, 3))
+        distributions = server._take_distributions(name, shape, ["EF single score", "Climate change"])
+        assert(distributions["confidence_score"].tolist() == [0.1, 0.7, 0.2])
+        assert(distributions["EF single score"].tolist() == [1.0, 2.0, 4.0])
+        assert(distributions["Climate change"].tolist() == [3.0, 5.0, 7.0])
+        with self.assertRaises(FileNotFoundError):
+            server._take_distributions(name, shape, ["EF single score", "Climate change"])
+
+
+    def testPoolDistributions(self):
+        categories = ["EF single score", "Climate change"]
+        prod = throughput_benchmark.load_products("explorer/binary/products.json")[0]
+        pool = server.EstimatorPool(1, categories)
+        try:
+            pool.wait_ready()
+            result = pool.estimate(prod, distributions=True)
+            distributions = result["distributions"]
+            assert("shared_distributions" not in result)
+            assert(set(distributions) == {"confidence_score"} | set(categories))
+            likeliest = int(np.argmax(distributions["confidence_score"]))
+            for category in categories:
+                assert(len(distributions[category]) == len(distributions["confidence_score"]))
+                assert(distributions[category][likeliest] == result["decoration"]["impact"]["likeliest_impacts"][category])
+            with self.assertRaises(server.EstimationTimeout):
+                pool.estimate(prod, deadline=0.001, distributions=True)
+        finally:
+            pool.close()
+        # Every shared memory block was unlinked, even the one of the estimation that timed out.
+        assert(glob.glob(f"/dev/shm/ie_{os.getpid()}_*") == [])
+
+
+    def testReduceImpacts(self):
+        rng = np.random.default_rng(1)
+        categories = ["EF single score", "Climate change"]
+        impacts = []
+        for runs in [30, 45, 1]:
+            impacts.append({
+                "confidence_score_distribution": rng.uniform(size=runs).tolist(),
+                "impact_distributions": {category: rng.lognormal(size=runs).tolist() for category in categories},
+                })
+        for impact in impacts:
+            summary = reducer.reduce_impact(impact, categories, percentiles=[5, 97.5])
+            likeliest = np.argmax(impact["confidence_score_distribution"])
+            assert(summary["likeliest_index"] == likeliest)
+            for category in categories:
+                distribution = np.array(impact["impact_distributions"][category])
+                assert(summary["likeliest_impacts"][category] == distribution[likeliest])
+                assert(np.isclose(summary["geom_means"][category], np.exp(np.mean(np.log(distribution)))))
+                assert(np.isclose(summary["log_stddevs"][category], np.std(np.log(distribution))))
+                assert(np.isclose(summary["percentiles"][category]["p5"], np.percentile(distribution, 5)))
+                assert(np.isclose(summary["percentiles"][category]["p97_5"], np.percentile(distribution, 97.5)))
+        assert("percentiles" not in reducer.reduce_impact(impacts[0], categories))
+        for impact in impacts:
+            impact.update({
+                "recipes": [{"en:water": 100}] * len(impact["confidence_score_distribution"]),
+                "uncharacterized_ingredients_mass_proportion": {"impact": 0, "nutrition": 0},
+                "uncharacterized_ingredients": {"impact": [], "nutrition": []},
+                "uncharacterized_ingredients_ratio": {"impact": 0, "nutrition": 0},
+                "warnings": [],
+                })
+        decoration = reducer.decoration(impacts[0], categories)["impact"]
+        assert(set(decoration["likeliest_impacts"]) == set(categories))
+        assert("ef_single_score_log_stddev" in decoration)
+        assert("climate_change_log_stddev" in decoration)
+        assert(reducer.category_slug("Particulate matter (PM2.5)") == "particulate_matter_pm2_5")
+        assert(server.parse_impact_categories("EF single score, Water use") == ["EF single score", "Water use"])
+        assert(server.parse_percentiles("5, 50,95") == (5, 50, 95))
+        assert(server.parse_percentiles("") == ())
+
+
+    def testAdaptiveDeadline(self):
+        prod = {"ingredients": [
+            {"id": "en:water"},
+            {"id": "en:chocolate", "ingredients": [{"id": "en:cocoa"}, {"id": "en:mystery", "is_in_taxonomy": 0}]},
+            ]}
+        assert(complexity.measure(prod) == {"ingredients": 4, "depth": 2, "unknown": 1})
+        assert(complexity.cost(prod) > complexity.cost({"ingredients": prod["ingredients"][:1]}))
+        deadlines = complexity.DeadlineModel(minimum=10, maximum=100, margin=2, min_history=3)
+        assert(deadlines.deadline(5) == 100)
+        for _ in range(3):
+            deadlines.observe(5, 10)
+        assert(deadlines.expected_seconds(5) == 10)
+        assert(deadlines.deadline(5) == 20)
+        assert(deadlines.deadline(1) == 10)
+        assert(deadlines.deadline(500) == 100)
+
+        calls = []
+        def estimate(min_run_nb, max_run_nb):
+            calls.append(max_run_nb)
+            time.sleep(0.001 * max_run_nb)
+            return {"confidence_score_distribution": [0] * max_run_nb}
+        impact, partial_runs = server._estimate_within(estimate, 0.2)
+        assert(calls[0] == server.MIN_RUNS)
+        assert(server.MIN_RUNS < calls[1] < 200)
+        assert(partial_runs == calls[1])
+        calls.clear()
+        impact, partial_runs = server._estimate_within(estimate, 0.01)
+        assert(calls == [server.MIN_RUNS])
+        assert(partial_runs == server.MIN_RUNS)
+
+        class TimingOutPool:
+            def __init__(self):
+                self.calls = []
+            def estimate(self, product, deadline=600, distributions=False, time_budget=None):
+                self.calls.append((deadline, time_budget))
+                raise server.EstimationTimeout("estimation", deadline)
+        serv = server.Server(cache_size=0, estimation_deadline=100, estimation_deadline_min=10)
+        serv.estimator_pool = TimingOutPool()
+        with self.assertRaises(server.EstimationTimeout):
+            serv._estimate_with_deadline(prod, deadline=30)
+        assert(serv.estimator_pool.calls == [(30, None), (70, 56)])
+        serv.estimator_pool.calls.clear()
+        with self.assertRaises(server.EstimationTimeout):
+            serv._estimate_with_deadline(prod, deadline=95)
+        assert(serv.estimator_pool.calls == [(95, None)])
+        timeouts = serv.get_stats()["estimation_timeouts"]
+        assert(timeouts == {"startup": 0, "adaptive_deadline": 2, "maximum_deadline": 0, "retry": 1})
+
+
+    def testScheduler(self):
+        sched = scheduler.Scheduler(10, expensive_cost=50)
+        for name, cost in [("a", 20), ("b", 100), ("c", 5), ("d", 60), ("e", 10)]:
+            sched.put(name, cost)
+        assert(sched.get(dedicated=True) == "d")
+        assert([sched.get() for _ in range(3)] == ["c", "e", "a"])
+        assert(sched.get() == "b")
+        sched.close()
+        assert(sched.get() is None)
+        assert(sched.get(dedicated=True) is None)
+        fifo = scheduler.Scheduler(10, policy="fifo")
+        for name, cost in [("a", 20), ("b", 100), ("c", 5)]:
+            fifo.put(name, cost)
+        assert([fifo.get() for _ in range(3)] == ["a", "b", "c"])
+        aging = scheduler.Scheduler(10, aging_seconds=0.01)
+        aging.put("old", 10)
+        time.sleep(0.2)
+        aging.put("new", 5)
+        assert(aging.get() == "old")
+
+
+    def testThroughputBenchmark(self):
+        products = throughput_benchmark.load_products("explorer/binary/products.json", sample=3)
+        assert(len(products) == 3)
+        assert(all("code" in prod for prod in products))
+        result = throughput_benchmark.run(products, 1, deadline=60)
+        assert(result["products"] == 3)
+        assert(result["failures"] + result["relative_errors"]["EF single score"]["count"] == 3)
+        assert(set(result["latency_seconds"]) == {"p50", "p95", "p99"})
+        json.dumps(result)
+
+
+    def testSimulator(self):
+        products = simulator.generate_products("explorer/binary/products.json", 30)
+        assert(len(set(prod["code"] for prod in products)) == 30)
+        result = simulator.run(
+                products,
+                port=8010,
+                duration=60,
+                update_faults=simulator.Faults(error_rate=0.2),
+                seed=1,
+                page_size=10,
+                poll_backoff_min=0.1,
+                cache_size=0)
+        assert(result["decorated"] == 30)
+        assert(result["products_per_hour"] > 0)
+        assert(result["productopener"]["update"]["injected_errors"] > 0)
+        # About one search per page, instead of one per decoration written.
+        assert(result["productopener"]["searches"] < 30)
+
+
+    def testShardedUpdateLoop(self):
+        codes = [str(code) for code in range(3000000000000, 3000000001000)]
+        shards = [server.shard_of(code, 3) for code in codes]
+        assert(all(shards.count(shard) > 250 for shard in range(3)))
+        products = simulator.generate_products("explorer/binary/products.json", 40)
+        result = simulator.run(products, port=8011, duration=60, replicas=2, page_size=5, poll_backoff_min=0.1, cache_size=0)
+        assert(result["decorated"] == 40)
+        for shard_index, stats in enumerate(result["servers"]):
+            mine = [prod for prod in products if server.shard_of(prod["code"], 2) == shard_index]
+            assert(stats["seen"] == len(mine))
+            assert(stats["skipped_other_shards"] > 0)
+        with self.assertRaises(ValueError):
+            server.Server(shard_index=2, shard_count=2)
+
+
+    def testRemoteUpdateLoop(self):
+        pool = server.EstimatorPool(1, server.DEFAULT_IMPACT_CATEGORIES)
+        # Refuses everything, since it reduces to other impact categories.
+        misconfigured_pool = server.EstimatorPool(1, ["Climate change"])
+        def worker_app(worker_pool):
+            worker = FastAPI()
+
+            @worker.post("/estimate")
+            async def estimate(request: Request):
+                if not remote.authorized("a token", request.headers.get("authorization")):
+                    return JSONResponse({"error": "wrong estimation token"}, status_code=401)
+                status, reply = remote.handle(worker_pool, json.loads(await request.body()))
+                return JSONResponse(reply, status_code=status)
+
+            return worker
+
+        workers = []
+        for port, worker_pool in [(8012, pool), (8014, misconfigured_pool)]:
+            worker = worker_app(worker_pool)
+            worker_server = uvicorn.Server(uvicorn.Config(worker, host="127.0.0.1", port=port, log_level="warning"))
+            thread = threading.Thread(target=worker_server.run, daemon=True)
+            thread.start()
+            workers.append((worker_server, thread))
+        for worker_server, _ in workers:
+            while not worker_server.started:
+                time.sleep(0.05)
+        try:
+            serv = server.Server(
+                    productopener_base_url="http://localhost:8000/",
+                    productopener_host_header=expected_host_header,
+                    productopener_username=expected_username,
+                    productopener_password=expected_password,
+                    # Nothing listens on 8013, and 8014 refuses everything, so
+                    # products sent there are dispatched again.
+                    estimation_endpoints=["http://127.0.0.1:8013", "http://127.0.0.1:8014", "http://127.0.0.1:8012/"],
+                    estimation_token="a token")
+            assert(serv.estimation_concurrency == 3)
+            self._checkUpdateLoop(serv)
+            assert(serv.estimator_pool.redispatched > 0)
+            assert(serv.get_stats()["estimate_impacts_success"] == len(PRODUCTS))
+            assert(serv.get_stats()["estimate_impacts_failure"] == 0)
+            status, reply = remote.handle(pool, {"product": PRODUCTS[0], "impact_categories": ["Climate change"]})
+            assert(status == 409)
+            assert("impact categories" in reply["error"])
+            status, reply = remote.handle(pool, {"product": PRODUCTS[0], "impact_categories": server.DEFAULT_IMPACT_CATEGORIES, "decoration_percentiles": [5]})
+            assert(status == 409)
+            assert("percentiles" in reply["error"])
+            assert(not remote.authorized("a token", None))
+            assert(not remote.authorized("a token", "Bearer another token"))
+            unauthorized = remote.RemoteEstimator(["http://127.0.0.1:8012"], server.DEFAULT_IMPACT_CATEGORIES, redispatches=0)
+            with self.assertRaises(server.WorkersUnavailable):
+                unauthorized.estimate(PRODUCTS[0])
+            unauthorized.close()
+        finally:
+            for worker_server, thread in workers:
+                worker_server.should_exit = True
+                thread.join()
+            pool.close()
+            misconfigured_pool.close()
+
+
+    def testUnchangedInputs(self):
+        serv = server.Server(cache_size=0)
+        prod = copy.deepcopy(PRODUCTS[0])
+        fingerprint = cache.input_fingerprint(prod, serv.estimator_version, serv.impact_categories)
+        edited = copy.deepcopy(prod)
+        edited["nutriments"] = dict(reversed(list(edited["nutriments"].items())))
+        assert(cache.input_fingerprint(edited, serv.estimator_version, serv.impact_categories) == fingerprint)
+        edited["nutriments"]["fat_100g"] = 99
+        assert(cache.input_fingerprint(edited, serv.estimator_version, serv.impact_categories) != fingerprint)
+        assert(cache.input_fingerprint(prod, serv.estimator_version + 1, serv.impact_categories) != fingerprint)
+        previous = {"impact": {"likeliest_impacts": {"EF_single_score": 1}}, "input_fingerprint": fingerprint}
+        prod["ecoscore_extended_data"] = previous
+        assert(serv._decorate_product(prod) == previous)
+        assert("ecoscore_extended_data" not in prod)
+        assert(serv.get_stats()["unchanged_inputs"] == 1)
+        assert(serv.get_stats()["estimate_impacts_success"] == 1)
+
+
+    def testErrorStats(self):
+        errors = server.ErrorStats(max_classes=2, max_recent=3)
+        for code in ["3920291118574", "3925359000501", "3927783004056"]:
+            errors.add(f"Exception: {{\"status\": 0, \"code\": \"{code}\"}}")
+            errors.add(f"Exception: estimation process got exception: KeyError: 'en:{code}'")
+        errors.add("Exception: Status 502")
+        snapshot = errors.snapshot()
+        assert(snapshot["total"] == 7)
+        assert(len(snapshot["classes"]) == 2)
+        assert(snapshot["classes"]["Exception: Status 502"] == 4)
+        assert(len(snapshot["recent"]) == 3)
+
+    def testResultCache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.sqlite")
+            c = cache.ResultCache(size=1, path=path)
+            fingerprint = cache.input_fingerprint(PRODUCTS[0], 1, ["EF single score"])
+            key = c.key(fingerprint, 4)
+            assert(key == c.key(cache.input_fingerprint(copy.deepcopy(PRODUCTS[0]), 1, ["EF single score"]), 4))
+            assert(key != c.key(fingerprint, 5))
+            assert(key != c.key(cache.input_fingerprint(PRODUCTS[0], 2, ["EF single score"]), 4))
+            assert(key != c.key(cache.input_fingerprint(PRODUCTS[1], 1, ["EF single score"]), 4))
+            assert(c.get(key) is None)
+            c.put(key, {"impact": {"warnings": []}})
+            c.put("other", {"impact": {}})
+            assert(list(c._entries.keys()) == ["other"])
+            assert(cache.ResultCache(size=1, path=path).get(key) == {"impact": {"warnings": []}})
+
+            pruned = cache.ResultCache(size=1, path=path, disk_size=3)
+            for idx in range(5):
+                pruned.put(f"key {idx}", {"idx": idx})
+            assert(pruned._db.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 3)
+            assert(cache.ResultCache(size=1, path=path).get("key 1") is None)
+            assert(cache.ResultCache(size=1, path=path).get("key 4") == {"idx": 4})
+
+            old_path = os.path.join(tmp, "old_cache.sqlite")
+            db = sqlite3.connect(old_path)
+            db.execute("CREATE TABLE results (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("INSERT INTO results (key, value) VALUES ('old', '{}')")
+            db.commit()
+            db.close()
+            assert(cache.ResultCache(size=1, path=old_path).get("old") == {})
+
+
+    def testJournal(self):
+        global search_responses
+        global updated_products
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "journal.jsonl")
+            j = journal.Journal(path, estimation_version=3)
+            j.record(PRODUCTS[3], "estimated", decoration={"error": "an older error"})
+            j.close()
+            j = journal.Journal(path, estimation_version=4)
+            assert(j.take_estimated() == [])
+            for prod in PRODUCTS[:3]:
+                j.record(prod, "fetched")
+                j.record(prod, "estimated", decoration={"error": "an error"})
+            j.record(PRODUCTS[0], "written")
+            j.close()
+            updated_products = []
+            search_responses = []
+            serv = server.Server(
+                    productopener_base_url="http://localhost:8000/",
+                    productopener_host_header=expected_host_header,
+                    productopener_username=expected_username,
+                    productopener_password=expected_password,
+                    journal_path=path)
+            serv.start_update_loop()
+            while serv.get_stats()["update_extended_data_success"] < 2:
+                time.sleep(0.2)
+            serv.stop_update_loop()
+            while serv.stats["status"] != "off":
+                time.sleep(0.2)
+            assert(sorted(updated_products) == sorted([PRODUCTS[1]["code"], PRODUCTS[2]["code"]]))
+            serv.journal.close()
+            # Compacted once everything was written.
+            assert(os.path.getsize(path) == 0)
+            assert(journal.Journal(path, estimation_version=serv.estimation_version).take_estimated() == [])
+            j = journal.Journal(path, compact_lines=3)
+            for prod in PRODUCTS[:2]:
+                j.record(prod, "fetched")
+                j.record(prod, "estimated", decoration={"error": "an error"})
+            j.close()
+            with open(path) as f:
+                assert(len(f.readlines()) == 2)
+
+        class FailingJournal:
+            def take_estimated(self):
+                return []
+            def record(self, prod, state, decoration=None):
+                raise OSError("No space left on device")
+        serv = server.Server(
+                productopener_base_url="http://localhost:8000/",
+                productopener_host_header=expected_host_header,
+                productopener_username=expected_username,
+                productopener_password=expected_password)
+        serv.journal = FailingJournal()
+        self._checkUpdateLoop(serv)
+        stats = serv.get_stats()
+        assert(stats["estimate_impacts_success"] + stats["estimate_impacts_failure"] == len(PRODUCTS))
+        assert(stats["update_extended_data_success"] == len(PRODUCTS))
+        assert(stats["update_extended_data_failure"] == 0)
+        assert(stats["update_latency_seconds"]["count"] == len(PRODUCTS))
+        assert(stats["errors"]["total"] >= 3 * len(PRODUCTS))
+
+
+    def testReadProducts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            array_path = os.path.join(tmp, "products.json")
+            with open(array_path, "w") as f:
+                json.dump(PRODUCTS, f, indent=2)
+            jsonl_path = os.path.join(tmp, "products.jsonl")
+            with open(jsonl_path, "w") as f:
+                for prod in PRODUCTS:
+                    f.write(json.dumps(prod) + "\n")
+            for path in [array_path, jsonl_path]:
+                assert(list(batch.read_products(path, chunk_size=100)) == PRODUCTS)
+
+
+    def testBatchRun(self):
+        serv = server.Server(cache_size=0)
+        def decorate(prod):
+            if prod["code"] == PRODUCTS[1]["code"]:
+                raise Exception("an error")
+            return {"impact": {}}
+        serv._decorate = decorate
+        with tempfile.TemporaryFile("w+") as out:
+            stats = batch.run(serv, copy.deepcopy(PRODUCTS[:3]) + [{"code": "no ingredients"}], out)
+            out.seek(0)
+            codes = [json.loads(line)["code"] for line in out]
+        assert(sorted(codes) == sorted([PRODUCTS[0]["code"], PRODUCTS[2]["code"]]))
+        assert(stats["read"] == 4)
+        assert(stats["skipped"] == 1)
+        assert(stats["written"] == 2)
+        assert(stats["failed"] == 1)
+
 
 if __name__ == "__main__":
     thread = threading.Thread(target=uvicorn.run, args=(mock,), kwargs={"host": "0.0.0.0", "port": 8000, "log_level": "info", "reload": False})
@@ -0,0 +1,255 @@
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+
+import requests
+import uvicorn
+
+import server
+
+
+class Backlog:
+    """The products of a simulated productopener, in a stable order. Like in
+    productopener, a product drops out of the search once a decoration of the
+    searched estimation version is written for it."""
+
+    def __init__(self, products):
+        self._products = products
+        self._versions = {}
+        self._decorations = {}
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.updates = 0
+
+    def search(self, version, page, page_size, fields=None):
+        with self._lock:
+            self.searches += 1
+            pending = [prod for prod in self._products if self._versions.get(prod["code"]) != version]
+            found = pending[(page - 1) * page_size:page * page_size]
+            found = [dict(prod, ecoscore_extended_data=self._decorations[prod["code"]]) if prod["code"] in self._decorations else prod for prod in found]
+        if fields is not None:
+            found = [{field: prod[field] for field in fields if field in prod} for prod in found]
+        return found
+
+    def update(self, code, version, decoration):
+        with self._lock:
+            self.updates += 1
+            self._versions[code] = version
+            self._decorations[code] = decoration
+
+    def decorated(self, version):
+        with self._lock:
+            return sum(1 for v in self._versions.values() if v == version)
+
+    def __len__(self):
+        return len(self._products)
+
+
+class Faults:
+    """Latency and errors to inject into the responses of an endpoint: every
+    response takes latency seconds (exponentially distributed around it), a
+    slow_rate fraction of them slow_latency seconds more, and an error_rate
+    fraction of them fail with a 503."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, slow_rate=0.0, slow_latency=5.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.injected_errors = 0
+        self.injected_slow = 0
+
+    async def inject(self, rng):
+        """Sleeps, and returns an error response to send instead of the real one, or None."""
+        delay = rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        if rng.random() < self.slow_rate:
+            self.injected_slow += 1
+            delay += self.slow_latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if rng.random() < self.error_rate:
+            self.injected_errors += 1
+            return JSONResponse({"status": 0, "error": "injected"}, status_code=503)
+        return None
+
+    def stats(self):
+        return {"injected_errors": self.injected_errors, "injected_slow": self.injected_slow}
+
+
+def create_app(backlog, search_faults=None, update_faults=None, seed=None):
+    """Returns a FastAPI app serving the search and update endpoints of
+    productopener used by the server, for the products of backlog."""
+    search_faults = search_faults or Faults()
+    update_faults = update_faults or Faults()
+    rng = random.Random(seed)
+    app = FastAPI()
+
+    @app.get("/api/v2/search")
+    async def api_v2_search(request: Request):
+        error = await search_faults.inject(rng)
+        if error is not None:
+            return error
+        params = request.query_params
+        version = None
+        match = re.search(r"-en:ecoscore-extended-data-version-(\d+)", params.get("misc_tags", ""))
+        if match:
+            version = match.group(1)
+        fields = params["fields"].split(",") if "fields" in params else None
+        products = backlog.search(version, int(params.get("page", "1")), int(params.get("page_size", "20")), fields)
+        return {"products": products}
+
+    @app.post("/cgi/product_jqm_multilingual.pl")
+    async def product_jqm_multilingual(request: Request):
+        error = await update_faults.inject(rng)
+        if error is not None:
+            return error
+        form = await request.form()
+        if "code" not in form or "ecoscore_extended_data" not in form or "ecoscore_extended_data_version" not in form:
+            return JSONResponse({"status": 0, "error": "missing fields"}, status_code=400)
+        backlog.update(form["code"], form["ecoscore_extended_data_version"], json.loads(form["ecoscore_extended_data"]))
+        return {"status": 1}
+
+    @app.get("/stats")
+    def stats():
+        return {
+                "products": len(backlog),
+                "searches": backlog.searches,
+                "updates": backlog.updates,
+                "search": search_faults.stats(),
+                "update": update_faults.stats(),
+                }
+
+    return app
+
+
+def generate_products(path, count, seed=1):
+    """Returns count products with distinct codes, sampled from the JSON array of
+    products in path (like explorer/binary/products.json)."""
+    with open(path) as f:
+        source = json.load(f)
+    rng = random.Random(seed)
+    products = []
+    for idx in range(count):
+        prod = copy.deepcopy(source[idx] if idx < len(source) else rng.choice(source))
+        products.append({
+            "code": f"{2000000000000 + idx}",
+            "product_name": prod.get("product_name", ""),
+            "ingredients": prod["ingredients"],
+            "nutriments": prod["nutriments"],
+            })
+    return products
+
+
+def run(products, port=8010, duration=None, search_faults=None, update_faults=None, seed=None, replicas=1, logging=logging.getLogger("simulator"), **server_options):
+    """Runs servers against a simulated productopener serving products, until
+    they are all decorated or duration seconds have passed, and returns the
+    end-to-end throughput along with the stats of both. Several replicas each
+    get a shard of the products."""
+    backlog = Backlog(products)
+    app = create_app(backlog, search_faults=search_faults, update_faults=update_faults, seed=seed)
+    simulated = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=simulated.run, daemon=True)
+    thread.start()
+    while not simulated.started:
+        time.sleep(0.05)
+    servers = []
+    for shard_index in range(replicas):
+        servers.append(server.Server(
+                logging=logging,
+                productopener_base_url=f"http://127.0.0.1:{port}/",
+                productopener_host_header="-",
+                productopener_username="simulator",
+                productopener_password="simulator",
+                shard_index=shard_index,
+                shard_count=replicas,
+                **server_options))
+    version = str(servers[0].estimation_version)
+    start = time.monotonic()
+    for serv in servers:
+        serv.start_update_loop()
+    try:
+        while backlog.decorated(version) < len(backlog):
+            if duration is not None and time.monotonic() - start > duration:
+                break
+            time.sleep(0.2)
+    finally:
+        seconds = time.monotonic() - start
+        for serv in servers:
+            serv.stop_update_loop()
+        for serv in servers:
+            while serv.stats["status"] != "off":
+                time.sleep(0.1)
+        simulated_stats = requests.get(f"http://127.0.0.1:{port}/stats").json()
+        simulated.should_exit = True
+        thread.join()
+    decorated = backlog.decorated(version)
+    replica_stats = []
+    for serv in servers:
+        stats = serv.get_stats()
+        replica_stats.append({key: stats[key] for key in [
+            "seen", "estimate_impacts_success", "estimate_impacts_failure",
+            "update_extended_data_success", "update_extended_data_failure",
+            "skipped_other_shards", "http_requests", "http_connections"]})
+    return {
+            "products": len(backlog),
+            "replicas": replicas,
+            "decorated": decorated,
+            "seconds": seconds,
+            "products_per_hour": 3600 * decorated / seconds if seconds > 0 else None,
+            "servers": replica_stats,
+            "productopener": simulated_stats,
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the end-to-end throughput of the server against a simulated productopener.")
+    parser.add_argument("--products", help="JSON array of products to generate the backlog from", default="explorer/binary/products.json")
+    parser.add_argument("--count", help="Number of products in the backlog", type=int, default=200)
+    parser.add_argument("--port", help="Port to serve the simulated productopener on", type=int, default=8010)
+    parser.add_argument("--duration", help="Seconds after which to stop, even if the backlog isn't decorated", type=float)
+    parser.add_argument("--seed", help="Seed of the generated backlog and the injected faults", type=int, default=1)
+    parser.add_argument("--search_latency", help="Mean seconds a search takes", type=float, default=0.2)
+    parser.add_argument("--update_latency", help="Mean seconds an update takes", type=float, default=0.05)
+    parser.add_argument("--error_rate", help="Fraction of searches and updates failing with a 503", type=float, default=0.0)
+    parser.add_argument("--slow_rate", help="Fraction of searches and updates taking slow_latency seconds more", type=float, default=0.0)
+    parser.add_argument("--slow_latency", help="Extra seconds slow responses take", type=float, default=5.0)
+    parser.add_argument("--replicas", help="Number of servers, each estimating a shard of the products", type=int, default=1)
+    parser.add_argument("--estimation_workers", help="Number of pre-warmed estimation processes to keep running in each server", type=int, default=1)
+    parser.add_argument("--page_size", help="Number of products to fetch per search page", type=int, default=20)
+    parser.add_argument("--writeback_concurrency", help="Number of decorations to write back concurrently (0 writes them one at a time)", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the results to, - for stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    result = run(
+            generate_products(args.products, args.count, seed=args.seed),
+            port=args.port,
+            duration=args.duration,
+            search_faults=Faults(args.search_latency, args.error_rate, args.slow_rate, args.slow_latency),
+            update_faults=Faults(args.update_latency, args.error_rate, args.slow_rate, args.slow_latency),
+            seed=args.seed,
+            replicas=args.replicas,
+            estimation_workers=args.estimation_workers,
+            page_size=args.page_size,
+            writeback_concurrency=args.writeback_concurrency,
+            cache_size=0)
+    out = sys.stderr if args.output == "-" else sys.stdout
+    print(f" * Decorated {result['decorated']} of {result['products']} products in {result['seconds']:.1f}s: {result['products_per_hour']:.0f} products/hour", file=out)
+    for idx, stats in enumerate(result["servers"]):
+        print(f" * Server {idx}: {stats}", file=out)
+    print(f" * Productopener: {result['productopener']}", file=out)
+    if args.output == "-":
+        json.dump(result, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,159 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import resource
+import sys
+import time
+
+import numpy as np
+
+import server
+
+
+# The names of the estimated impact categories in the Agribalyse impacts of
+# explorer/binary/products.json, which are per kg.
+TRUTH_CATEGORIES = {
+        "EF single score": "Score unique EF",
+        "Climate change": "Changement climatique",
+        }
+
+
+def load_products(path, sample=None, seed=1):
+    with open(path) as f:
+        products = json.load(f)
+    for idx, prod in enumerate(products):
+        prod.setdefault("code", str(prod.get("ciqual_code", idx)))
+    if sample is not None and sample < len(products):
+        products = random.Random(seed).sample(products, sample)
+    return products
+
+
+def _percentiles(values, qs=(50, 95, 99)):
+    if len(values) == 0:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": float(np.percentile(values, q)) for q in qs}
+
+
+def _error_summary(errors):
+    summary = {"count": len(errors), "mean": float(np.mean(errors)) if len(errors) > 0 else None}
+    summary.update(_percentiles(errors, qs=(50, 90)))
+    return summary
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _workers_max_rss_mb(pool):
+    """Returns the largest peak RSS of the running worker processes of pool. They
+    are forked by the forkserver, so getrusage can't see them, but /proc can."""
+    peak = None
+    for p, _ in list(pool._workers):
+        try:
+            with open(f"/proc/{p.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        rss = int(line.split()[1]) / 1024
+                        peak = rss if peak is None else max(peak, rss)
+        except OSError:
+            pass
+    return peak
+
+
+def run(products, workers, deadline=None, logging=logging.getLogger("benchmark")):
+    """Estimates products with workers pre-warmed processes and as many concurrent
+    estimations, and returns the throughput, the latency percentiles of the
+    estimations, and the relative errors of the likeliest impacts against the
+    Agribalyse impacts of the products."""
+    serv = server.Server(logging=logging, estimation_workers=workers, cache_size=0)
+    latencies = []
+    errors = {category: [] for category in TRUTH_CATEGORIES}
+    failures = []
+
+    def estimate(prod):
+        start = time.monotonic()
+        try:
+            result = serv._estimate_with_deadline(prod, deadline=deadline)
+        except Exception as e:
+            failures.append(f"{e.__class__.__name__}: {e}")
+            return
+        latencies.append(time.monotonic() - start)
+        likeliest = result["decoration"]["impact"]["likeliest_impacts"]
+        for category, truth_category in TRUTH_CATEGORIES.items():
+            truth = prod.get("impacts", {}).get(truth_category)
+            if truth:
+                # 10 * since the estimations are for 100g while the Agribalyse impacts are for 1kg.
+                estimated = 10 * float(likeliest[category])
+                errors[category].append(abs(estimated - truth) / truth)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        startup = time.monotonic()
+        serv.estimator_pool.wait_ready()
+        startup = time.monotonic() - startup
+        start = time.monotonic()
+        list(executor.map(estimate, products))
+        seconds = time.monotonic() - start
+    workers_rss = _workers_max_rss_mb(serv.estimator_pool)
+    serv.estimator_pool.close()
+    result = {
+            "workers": workers,
+            "products": len(products),
+            "failures": len(failures),
+            "startup_seconds": startup,
+            "seconds": seconds,
+            "products_per_second": len(products) / seconds if seconds > 0 else None,
+            "latency_seconds": _percentiles(latencies),
+            "relative_errors": {category: _error_summary(errors[category]) for category in TRUTH_CATEGORIES},
+            "max_rss_mb": {
+                "parent": _max_rss_mb(),
+                "worker": workers_rss,
+                },
+            }
+    if len(failures) > 0:
+        result["first_failure"] = failures[0]
+    return result
+
+
+def _print(result, out):
+    print(f" * {result['workers']} workers: {result['products']} products in {result['seconds']:.1f}s, {result['failures']} failed", file=out)
+    print(f"   * {result['products_per_second']:.2f} products/s after {result['startup_seconds']:.1f}s of worker startup", file=out)
+    latency = result["latency_seconds"]
+    if latency["p50"] is not None:
+        print(f"   * latency p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s, p99 {latency['p99']:.2f}s", file=out)
+    for category, errors in result["relative_errors"].items():
+        if errors["count"] > 0:
+            print(f"   * {category} relative error median {errors['p50']:.2f}, p90 {errors['p90']:.2f}, mean {errors['mean']:.2f}", file=out)
+    print(f"   * max RSS {result['max_rss_mb']['parent']:.0f}MB in the parent, {result['max_rss_mb']['worker'] or 0:.0f}MB in a worker", file=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput, latency, memory use and accuracy of the estimations of the explorer products.")
+    parser.add_argument("--products", help="JSON array of products with Agribalyse impacts", default="explorer/binary/products.json")
+    parser.add_argument("--sample", help="Number of randomly picked products to estimate, instead of all of them", type=int)
+    parser.add_argument("--seed", help="Seed of the product sample", type=int, default=1)
+    parser.add_argument("--workers", help="Comma separated numbers of estimation workers to run the benchmark with, 1 being serial", default="1,4")
+    parser.add_argument("--deadline", help="Seconds before an estimation times out (derived from the product by default)", type=float)
+    parser.add_argument("--output", help="JSON file to write the results to, - for stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    products = load_products(args.products, sample=args.sample, seed=args.seed)
+    results = {
+            "products_path": args.products,
+            "sample": args.sample,
+            "seed": args.seed,
+            "runs": [],
+            }
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = run(products, workers, deadline=args.deadline)
+        # Keep stdout for the JSON results when they go there.
+        _print(result, sys.stderr if args.output == "-" else sys.stdout)
+        results["runs"].append(result)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
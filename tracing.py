@@ -0,0 +1,79 @@
+import contextlib
+import json
+import threading
+import time
+
+
+class Tracer:
+    """Receives callbacks when a product enters and leaves a stage of the update
+    loop. The stages are "fetch" (without product code), "estimate" (including the
+    cache), "worker_wait", "worker_startup" and "estimation" (in the worker process),
+    "bsonify" and "write".
+
+    Callbacks run on the thread doing the work, so they must be quick and thread
+    safe. attributes holds stage specific details, like "profile" for slow
+    estimations when profiling is enabled."""
+
+    def start(self, stage, code):
+        pass
+
+    def end(self, stage, code, seconds, error, attributes):
+        pass
+
+
+class JsonlTracer(Tracer):
+    """Writes one JSON line per finished span to path.
+    With profile_threshold set, estimations running longer than that many seconds
+    get the top of their cProfile output attached."""
+
+    def __init__(self, path, profile_threshold=None):
+        self.profile_threshold = profile_threshold
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def end(self, stage, code, seconds, error, attributes):
+        span = {
+                "stage": stage,
+                "code": code,
+                "start": time.time() - seconds,
+                "seconds": seconds,
+                }
+        if error is not None:
+            span["error"] = error
+        span.update(attributes)
+        line = json.dumps(span, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Spans:
+    """Calls a list of tracers around the stages of a product."""
+
+    def __init__(self, tracers=None):
+        self.tracers = tracers if tracers is not None else []
+
+    @contextlib.contextmanager
+    def span(self, stage, code=None):
+        """Yields a dict that the stage can fill with attributes for the tracers."""
+        if len(self.tracers) == 0:
+            yield {}
+            return
+        for tracer in self.tracers:
+            tracer.start(stage, code)
+        start = time.monotonic()
+        attributes = {}
+        error = None
+        try:
+            yield attributes
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            seconds = time.monotonic() - start
+            for tracer in self.tracers:
+                tracer.end(stage, code, seconds, error, attributes)
@@ -0,0 +1,86 @@
+import aiohttp
+import asyncio
+import threading
+import time
+
+
+class AsyncWriteback:
+    """Posts decorations to productopener from an asyncio event loop running in a
+    thread of its own, with at most concurrency requests in flight, so that slow
+    writes don't hold up the estimations.
+
+    Transient failures (connection problems, timeouts and 5xx responses) are
+    retried with exponential backoff, and the outcome and latency of every write
+    is reported back to the server."""
+
+    def __init__(self, server, concurrency, retries=3, retry_delay=0.5):
+        self.server = server
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._loop = None
+        self._thread = None
+        self._session = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, args=(), daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._open_session(), self._loop).result()
+
+    async def _open_session(self):
+        auth = None
+        if self.server.auth is not None:
+            auth = aiohttp.BasicAuth(self.server.auth.username, self.server.auth.password)
+        self._session = aiohttp.ClientSession(
+                auth=auth,
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.server.http_timeout))
+
+    def submit(self, prod, decoration):
+        """Schedules storing decoration for prod, blocking while concurrency
+        writes are already in flight."""
+        self._slots.acquire()
+        asyncio.run_coroutine_threadsafe(self._write(prod, decoration), self._loop)
+
+    def drain(self):
+        """Blocks until all submitted writes are done."""
+        for _ in range(self.concurrency):
+            self._slots.acquire()
+        for _ in range(self.concurrency):
+            self._slots.release()
+
+    def close(self):
+        if self._loop is None:
+            return
+        self.drain()
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    async def _write(self, prod, decoration):
+        start = time.monotonic()
+        error = None
+        try:
+            url, params, headers = self.server._update_request(prod, decoration)
+            with self.server.spans.span("write", prod.get("code")):
+                for attempt in range(self.retries + 1):
+                    try:
+                        async with self._session.post(url, data=params, headers=headers) as response:
+                            text = await response.text()
+                            if response.status < 500 or attempt == self.retries:
+                                self.server._check_update_response(prod, decoration, response.status, text)
+                                break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        if attempt == self.retries:
+                            raise
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        except Exception as e:
+            error = e
+        try:
+            self.server._stored(prod, error, time.monotonic() - start)
+        finally:
+            self._slots.release()